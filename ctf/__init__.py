@@ -3,7 +3,7 @@ import os
 import flask
 import redis
 from werkzeug import exceptions
-from . import api, core, frontend, ext, setup
+from . import api, cli, core, files, frontend, ext, instrument, setup
 from .models import db
 
 
@@ -28,11 +28,18 @@ def create_app():
     # Setup extensions
     ext.db.init_app(app)
     ext.csrf.init_app(app)
+    instrument.init_app(app)
 
-    @app.before_first_request
-    def create_db():
-        db.create_all()
-        setup.build_challenges()
+    if app.config.get('SETUP_ON_FIRST_REQUEST', True):
+        # Convenient for development, but every worker repeats it; in
+        # production run `flask ctf init-db` and `flask ctf sync-challenges`
+        # once at deploy time instead
+        @app.before_first_request
+        def create_db():
+            db.create_all()
+            setup.build_challenges()
+
+    app.cli.add_command(cli.cli)
 
     @app.context_processor
     def inject_jinja_globals():
@@ -53,6 +60,7 @@ def create_app():
         app.register_error_handler(code, handle_error)
 
     app.register_blueprint(frontend.bp)
+    app.register_blueprint(files.bp)
     app.register_blueprint(api.bp, url_prefix='/api')
 
     return app
@@ -1,12 +1,13 @@
 """JSON Bourne API"""
-from flask import Blueprint, request, current_app, abort, Response, jsonify, \
-    send_from_directory
+from flask import Blueprint, request, current_app, abort, g, Response, \
+    jsonify
 from itsdangerous import Signer, BadSignature, want_bytes
 from werkzeug import exceptions
 from functools import wraps
-from . import core, ext
+from . import cache, core, ext, files
 from ._compat import text_type
-from .core import CtfException
+from .core import CtfException, RateLimitException
+import json
 
 
 bp = Blueprint('api', __name__)
@@ -52,6 +53,20 @@ def get_signer():
     return Signer(current_app.secret_key, salt='wrath-ctf')
 
 
+SESSION_HEADER = 'X-Session-Key'
+SESSION_ERROR = 'A valid {0} header is required.'.format(SESSION_HEADER)
+
+
+def token_from_header():
+    """Return the session token from the request, or abort with a 403."""
+    key = request.headers.get(SESSION_HEADER, '')
+    try:
+        signer = get_signer()
+        return signer.unsign(key).decode('utf-8')
+    except (BadSignature, ValueError):
+        abort(403, SESSION_ERROR)
+
+
 def ensure_user(view_func):
     """Decorator that errors if the user is not logged in.
 
@@ -59,17 +74,9 @@ def ensure_user(view_func):
     """
     @wraps(view_func)
     def inner(*args, **kwargs):
-        header_name = 'X-Session-Key'
-        err_msg = 'A valid {0} header is required.'.format(header_name)
-        key = request.headers.get(header_name, '')
-        try:
-            signer = get_signer()
-            token = signer.unsign(key).decode('utf-8')
-        except (BadSignature, ValueError):
-            abort(403, err_msg)
-        user = core.user_for_token(token)
+        user = core.user_for_token(token_from_header())
         if user is None:
-            abort(403, err_msg)
+            abort(403, SESSION_ERROR)
         return view_func(user, *args, **kwargs)
     return inner
 
@@ -77,14 +84,21 @@ def ensure_user(view_func):
 def ensure_team(view_func):
     """Decorator that errors if the user is not part of a team.
 
-    This is analagous to frontend.ensure_team
+    This is analagous to frontend.ensure_team. Only the team is loaded from
+    the database; the user comes from the cached identity.
     """
     @wraps(view_func)
-    @ensure_user
-    def inner(user, *args, **kwargs):
-        if user.team is None:
+    def inner(*args, **kwargs):
+        identity = core.identity_for_token(token_from_header())
+        if identity is None:
+            abort(403, SESSION_ERROR)
+        if identity.team_id is None:
+            abort(403, 'You must be part of a team.')
+        team = core.load_team(identity.team_id)
+        if team is None:
             abort(403, 'You must be part of a team.')
-        return view_func(user.team, *args, **kwargs)
+        g.identity = identity
+        return view_func(team, *args, **kwargs)
     return inner
 
 
@@ -183,15 +197,48 @@ def leave_team(user):
     return Response(status=204)
 
 
-@bp.route('/teams/')
-def leaderboard():
-    teams = core.get_teams()
-    return jsonify({
+def build_leaderboard():
+    return json.dumps({
         'teams': [{
             'id': team.id,
             'name': team.name,
             'points': team.score,
-        } for team in teams],
+        } for team in core.get_teams()],
+    })
+
+
+@bp.route('/teams/')
+def leaderboard():
+    data = cache.get_leaderboard('api', build_leaderboard)
+    return Response(data, mimetype='application/json')
+
+
+@bp.route('/teams/stream')
+def leaderboard_stream():
+    """Server-Sent Events feed of scoreboard changes.
+
+    Each event is a team's new {id, name, points, rank}, or {reload: true}
+    when the whole board changed.
+    """
+    pubsub = current_app.redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(core.SCOREBOARD_CHANNEL)
+
+    def events():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                message = pubsub.get_message(timeout=15)
+                if message is None:
+                    # Comment line, keeps proxies from timing us out
+                    yield ': keepalive\n\n'
+                else:
+                    yield 'data: %s\n\n' % message['data'].decode('utf-8')
+        finally:
+            pubsub.close()
+
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
     })
 
 
@@ -240,25 +287,39 @@ def invite_user(team, username):
 @param('flag', text_type)
 def submit_fleg(team, flag):
     try:
-        solved = core.add_fleg(flag, team)
+        solved = core.add_fleg(flag, team, request.remote_addr,
+                               g.identity.user_id)
+    except RateLimitException as exc:
+        return jsonify({'message': exc.message}), 429, \
+            {'Retry-After': str(exc.retry_after)}
     except CtfException as exc:
         abort(400, exc.message)
-    return jsonify({'points_earned': solved.points}), 201
+    return jsonify({'points_earned': solved.value}), 201
+
+
+def challenge_info(chal):
+    """Return chal_info, plus a signed download URL for each resource."""
+    info = chal.chal_info()
+    info['resource_urls'] = dict((r.name, files.signed_url(r))
+                                 for r in chal.resources)
+    return info
 
 
 @bp.route('/challenges/')
 @ensure_team
 def view_challenges(team):
-    chal_dicts = map(lambda c: c.chal_info(), core.get_challenges(team))
+    chal_dicts = map(challenge_info, core.get_challenges(team))
     return jsonify({"challenges": list(chal_dicts)})
 
 
 @bp.route('/challenges/<int:id>/')
 @ensure_team
-def challenge_info(team, id):
+def view_challenge(team, id):
     chal = core.get_challenge(team, id)
-    ret = chal.chal_info()
-    ret.update({"solved": chal in team.challenges})
+    if chal is None:
+        abort(404)
+    ret = challenge_info(chal)
+    ret.update({"solved": chal.id in core.solved_ids(team)})
     return jsonify(ret)
 
 
@@ -268,4 +329,7 @@ def get_resource(team, name):
     resource = core.get_resource(team, name)
     if resource is None:
         abort(404)
-    return send_from_directory(resource.path, resource.name)
+    rv = files.send_resource(resource)
+    if rv is None:
+        abort(404)
+    return rv
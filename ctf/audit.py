@@ -0,0 +1,139 @@
+"""Write-behind log of every flag submission.
+
+core.add_fleg appends each submission to a capped Redis stream, a single
+XADD in the request path. archive() later moves entries, in batches, into
+the submission table or into gzipped JSONL files, remembering the last
+entry it archived in Redis.
+
+Logging is off unless SUBMISSION_LOG_MAXLEN is set (e.g. 1000000), and the
+stream then holds about that many entries; older ones are trimmed whether or
+not they were archived, so keep the archiver running during the event. A
+failed XADD is logged and otherwise ignored, so it never fails a submission.
+"""
+from flask import current_app
+from datetime import datetime
+from redis.exceptions import RedisError
+from .ext import db
+from .models import Submission
+import gzip
+import json
+import logging
+import os
+
+
+STREAM_KEY = 'submissions'
+CHECKPOINT_KEY = 'submissions.archived'
+
+# Enough to tell guesses apart without keeping whole flag hashes around
+HASH_PREFIX_LENGTH = 16
+
+FIELDS = ('team', 'user', 'ip', 'challenge', 'hash', 'outcome')
+
+logger = logging.getLogger(__name__)
+
+
+def log_submission(outcome, team_id, fleg_hash, ip=None, user_id=None,
+                   challenge_id=None):
+    maxlen = current_app.config.get('SUBMISSION_LOG_MAXLEN')
+    if not maxlen:
+        return
+    values = (team_id, user_id, ip, challenge_id,
+              fleg_hash[:HASH_PREFIX_LENGTH], outcome)
+    fields = dict((name, '' if value is None else value)
+                  for name, value in zip(FIELDS, values))
+    try:
+        # Approximate trimming lets Redis drop whole nodes, lazily
+        current_app.redis.xadd(STREAM_KEY, fields, maxlen=maxlen,
+                               approximate=True)
+    except RedisError:
+        # The submission itself went through, maybe with a solve saved
+        logger.exception('Could not log a %s submission by team %s',
+                         outcome, team_id)
+
+
+def next_id(entry_id):
+    """The smallest stream id after entry_id (XRANGE's start is inclusive)."""
+    ms, seq = entry_id.split('-')
+    return '%s-%d' % (ms, int(seq) + 1)
+
+
+def read_entries(after, count):
+    """Return up to count (id, fields) entries logged after id after."""
+    start = next_id(after) if after else '-'
+    entries = current_app.redis.xrange(STREAM_KEY, min=start, count=count)
+    result = []
+    for entry_id, fields in entries:
+        fields = dict((k.decode('utf-8'), v.decode('utf-8'))
+                      for k, v in fields.items())
+        result.append((entry_id.decode('ascii'), fields))
+    return result
+
+
+def to_record(entry_id, fields):
+    def optional_int(value):
+        return int(value) if value else None
+
+    return {
+        'id': entry_id,
+        'submitted_at': datetime.utcfromtimestamp(
+            int(entry_id.split('-')[0]) / 1000.0),
+        'team_id': optional_int(fields.get('team')),
+        'user_id': optional_int(fields.get('user')),
+        'ip': fields.get('ip') or None,
+        'challenge_id': optional_int(fields.get('challenge')),
+        'hash_prefix': fields.get('hash'),
+        'outcome': fields.get('outcome'),
+    }
+
+
+def archive_to_db(records):
+    """Insert records into the submission table, skipping any already
+    there (from a run that stopped before saving its checkpoint)."""
+    ids = [r['id'] for r in records]
+    existing = set(row[0] for row in db.session.query(Submission.id)
+                   .filter(Submission.id.in_(ids)))
+    rows = [r for r in records if r['id'] not in existing]
+    if rows:
+        db.session.execute(Submission.__table__.insert(), rows)
+    db.session.commit()
+
+
+def file_archiver(directory):
+    """Return an archiver appending records to a gzipped JSONL file per day.
+
+    Unlike the table, files may repeat entries if archiving is interrupted
+    between writing and checkpointing.
+    """
+    def archive_to_files(records):
+        by_day = {}
+        for record in records:
+            record = dict(record)
+            submitted_at = record['submitted_at']
+            record['submitted_at'] = submitted_at.isoformat() + 'Z'
+            by_day.setdefault(submitted_at.strftime('%Y-%m-%d'), []) \
+                .append(record)
+        for day, day_records in sorted(by_day.items()):
+            filename = os.path.join(directory,
+                                    'submissions-%s.jsonl.gz' % day)
+            # Each append is a new gzip member; zcat reads them all
+            with gzip.open(filename, 'ab') as f:
+                for record in day_records:
+                    f.write(json.dumps(record, sort_keys=True)
+                            .encode('utf-8') + b'\n')
+    return archive_to_files
+
+
+def archive(archiver=archive_to_db, batch_size=500):
+    """Archive one batch of entries after the checkpoint with archiver.
+
+    Returns how many entries were archived; 0 means it is caught up.
+    """
+    redis = current_app.redis
+    after = redis.get(CHECKPOINT_KEY)
+    entries = read_entries(after.decode('ascii') if after else None,
+                           batch_size)
+    if not entries:
+        return 0
+    archiver([to_record(entry_id, fields) for entry_id, fields in entries])
+    redis.set(CHECKPOINT_KEY, entries[-1][0])
+    return len(entries)
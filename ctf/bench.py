@@ -0,0 +1,160 @@
+"""Benchmarks that drive core directly, against the configured database."""
+from flask import current_app
+from sqlalchemy.exc import OperationalError
+from . import api, core, ingest, passwords
+from .ext import db
+from .models import Challenge, Solve, Team, User
+import random
+import threading
+import time
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+
+BENCH_PREFIX = 'bench-'
+BENCH_PASSWORD = 'bench-password'
+
+
+def seed(teams, challenges):
+    """Create benchmark teams and challenges, returning their ids and flegs.
+
+    Everything seeded is named with BENCH_PREFIX so cleanup() can find it.
+    """
+    flegs = {}
+    for i in range(challenges):
+        fleg = '%sfleg-%d' % (BENCH_PREFIX, i)
+        chal = Challenge(title='%schallenge-%d' % (BENCH_PREFIX, i),
+                         description='Benchmark challenge',
+                         category='benchmark', points=1,
+                         fleg_hash=core.hash_fleg(fleg))
+        db.session.add(chal)
+        flegs[chal] = fleg
+    team_objs = [Team(name='%steam-%d' % (BENCH_PREFIX, i))
+                 for i in range(teams)]
+    db.session.add_all(team_objs)
+    db.session.commit()
+    core.challenges_changed()
+    return [t.id for t in team_objs], list(flegs.values())
+
+
+def seed_players(users, teams, challenges):
+    """Seed teams and challenges as seed() does, plus users spread across
+    the teams, all with BENCH_PASSWORD and already logged in.
+
+    Returns a list of (username, signed session key) and the flegs.
+    """
+    team_ids, flegs = seed(teams, challenges)
+    # Hashed once; logging in as any of them still costs a full verify
+    pw_hash = passwords.hash_password(BENCH_PASSWORD.encode('utf-8'))
+    user_objs = [User(name='%suser-%d' % (BENCH_PREFIX, i), password=pw_hash,
+                      team_id=team_ids[i % len(team_ids)])
+                 for i in range(users)]
+    db.session.add_all(user_objs)
+    db.session.commit()
+    return [(u.name, api.create_signed_key(u)) for u in user_objs], flegs
+
+
+def cleanup():
+    """Delete everything seed() and seed_players() created."""
+    teams = db.session.query(Team.id).filter(
+        Team.name.startswith(BENCH_PREFIX))
+    chals = db.session.query(Challenge.id).filter(
+        Challenge.title.startswith(BENCH_PREFIX))
+    User.query.filter(User.name.startswith(BENCH_PREFIX)) \
+        .delete(synchronize_session=False)
+    Solve.query.filter(Solve.team_id.in_(teams.subquery())) \
+        .delete(synchronize_session=False)
+    Team.query.filter(Team.id.in_(teams.subquery())) \
+        .delete(synchronize_session=False)
+    Challenge.query.filter(Challenge.id.in_(chals.subquery())) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+    core.challenges_changed()
+    core.scoreboard_changed()
+    core.invalidate_identities()
+
+
+def solve_throughput(teams=20, challenges=20, threads=8, queued=False):
+    """Submit every seeded fleg for every seeded team from several threads.
+
+    Rate limits and the competition window are lifted for the run. Returns
+    the number of solves, how many failed on database errors (e.g.
+    "database is locked"), the elapsed seconds and solves per second.
+
+    With queued, solves go through SOLVE_QUEUE with a writer thread
+    draining it; the figures are then for acknowledgements, and 'saved'
+    is the number of seconds until every solve was written.
+    """
+    app = current_app._get_current_object()
+    ctf_config = app.config['CTF']
+    saved = dict(ctf_config)
+    ctf_config.update({
+        'rate_limits': {'team': None, 'ip': None},
+        'start_time': '2000-01-01T00:00:00.000Z',
+        'end_time': '2999-01-01T00:00:00.000Z',
+    })
+    saved_queue = app.config.get('SOLVE_QUEUE')
+    app.config['SOLVE_QUEUE'] = queued
+
+    cleanup()
+    team_ids, flegs = seed(teams, challenges)
+    work = Queue()
+    jobs = [(t, f) for t in team_ids for f in flegs]
+    random.shuffle(jobs)
+    for job in jobs:
+        work.put(job)
+    results = {'solves': 0, 'errors': 0}
+    lock = threading.Lock()
+
+    def worker():
+        with app.app_context():
+            while True:
+                try:
+                    team_id, fleg = work.get_nowait()
+                except Empty:
+                    break
+                outcome = 'solves'
+                try:
+                    core.add_fleg(fleg, core.load_team(team_id))
+                except OperationalError:
+                    db.session.rollback()
+                    outcome = 'errors'
+                with lock:
+                    results[outcome] += 1
+            db.session.remove()
+
+    submitting = threading.Event()
+    submitting.set()
+
+    def writer():
+        with app.app_context():
+            while ingest.drain_solves() or submitting.is_set():
+                time.sleep(0.01)
+            db.session.remove()
+
+    start = time.time()
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    if queued:
+        pool.append(threading.Thread(target=writer))
+    for thread in pool:
+        thread.start()
+    for thread in pool[:threads]:
+        thread.join()
+    elapsed = time.time() - start
+    submitting.clear()
+    for thread in pool[threads:]:
+        thread.join()
+    if queued:
+        results['saved'] = time.time() - start
+
+    cleanup()
+    ctf_config.clear()
+    ctf_config.update(saved)
+    app.config['SOLVE_QUEUE'] = saved_queue
+
+    results['seconds'] = elapsed
+    results['rate'] = results['solves'] / elapsed
+    return results
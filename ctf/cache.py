@@ -0,0 +1,69 @@
+"""Shared leaderboard cache, kept in app.redis.
+
+Rendered leaderboards are stored under a generation number that
+invalidate_leaderboard() bumps whenever the ranking can change. A miss is
+rebuilt by a single worker; everyone else serves the previous rendering (or
+waits briefly for the new one if there is none yet).
+"""
+from flask import current_app
+from . import counters
+import time
+
+
+GENERATION_KEY = 'leaderboard.generation'
+LOCK_TIMEOUT = 10
+POLL_INTERVAL = 0.05
+
+
+def invalidate_leaderboard():
+    current_app.redis.incr(GENERATION_KEY)
+
+
+def get_leaderboard(name, build):
+    """Return the cached rendering called name, calling build() on a miss.
+
+    build must return bytes or text; the cached value is always bytes.
+    """
+    redis = current_app.redis
+    timeout = current_app.config.get('LEADERBOARD_CACHE_TIMEOUT', 300)
+    generation = int(redis.get(GENERATION_KEY) or 0)
+    key = 'leaderboard.%s.%d' % (name, generation)
+    stale_key = 'leaderboard.%s.last' % name
+
+    value = redis.get(key)
+    if value is not None:
+        counters.incr('ctf_leaderboard_cache_total',
+                      {'name': name, 'result': 'hit'})
+        return value
+
+    lock_key = key + '.lock'
+    locked = redis.set(lock_key, 1, nx=True, ex=LOCK_TIMEOUT)
+    if not locked:
+        # Somebody else is rebuilding this generation
+        value = redis.get(stale_key)
+        deadline = time.time() + LOCK_TIMEOUT
+        while value is None and time.time() < deadline:
+            time.sleep(POLL_INTERVAL)
+            value = redis.get(key)
+        if value is not None:
+            counters.incr('ctf_leaderboard_cache_total',
+                          {'name': name, 'result': 'stale'})
+            return value
+
+    counters.incr('ctf_leaderboard_cache_total',
+                  {'name': name, 'result': 'miss'})
+    try:
+        start = time.time()
+        value = build()
+        counters.observe('ctf_leaderboard_build_seconds',
+                         time.time() - start, {'name': name})
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        pipe = redis.pipeline()
+        pipe.set(key, value, ex=timeout)
+        pipe.set(stale_key, value)
+        pipe.execute()
+    finally:
+        if locked:
+            redis.delete(lock_key)
+    return value
@@ -0,0 +1,208 @@
+"""Management commands, available as `flask ctf <command>`."""
+from flask import current_app
+from flask.cli import AppGroup
+from . import audit, bench, core, ingest, loadtest, passwords, setup
+from .ext import db
+import click
+import time
+
+
+cli = AppGroup('ctf', help='Manage the CTF.')
+
+
+@cli.command('init-db')
+def init_db():
+    """Create any missing database tables."""
+    db.create_all()
+    click.echo('Database tables created.')
+
+
+@cli.command('migrate-db')
+def migrate_db():
+    """Add missing tables, columns and indexes to an existing database."""
+    changes = setup.migrate_db()
+    for change in changes:
+        click.echo(change)
+    if not changes:
+        click.echo('The database is up to date.')
+
+
+@cli.command('sync-challenges')
+def sync_challenges():
+    """Import challenges from the problems.json files."""
+    report = setup.build_challenges()
+    click.echo('{added} added, {changed} changed, {unchanged} unchanged.'
+               .format(**report))
+
+
+@cli.command('watch-challenges')
+@click.option('--interval', default=2.0, help='Seconds between checks.')
+def watch_challenges(interval):
+    """Re-import challenges whenever a problems.json file changes.
+
+    Running workers pick up the new challenges on their next request.
+    """
+    last_seen = None
+    while True:
+        seen = setup.config_mtimes()
+        if seen != last_seen:
+            try:
+                report = setup.build_challenges()
+            except (IOError, ValueError) as exc:
+                click.echo('Not reloading: {0}'.format(exc), err=True)
+            else:
+                click.echo('{added} added, {changed} changed, '
+                           '{unchanged} unchanged.'.format(**report))
+            last_seen = seen
+        time.sleep(interval)
+
+
+@cli.command('archive-submissions')
+@click.option('--to-dir', type=click.Path(file_okay=False, writable=True),
+              help='Append to gzipped JSONL files here instead of the '
+              'submission table.')
+@click.option('--batch', default=500, help='Entries per batch.')
+@click.option('--follow', is_flag=True,
+              help='Keep archiving new submissions as they arrive.')
+@click.option('--interval', default=1.0,
+              help='Seconds to wait when caught up, with --follow.')
+def archive_submissions(to_dir, batch, follow, interval):
+    """Move logged flag submissions out of Redis into the archive."""
+    archiver = audit.file_archiver(to_dir) if to_dir else audit.archive_to_db
+    total = 0
+    while True:
+        count = audit.archive(archiver, batch)
+        total += count
+        if count:
+            continue
+        if not follow:
+            break
+        if total:
+            click.echo('{0} submissions archived.'.format(total))
+            total = 0
+        time.sleep(interval)
+    click.echo('{0} submissions archived.'.format(total))
+
+
+@cli.command('ingest-solves')
+@click.option('--batch', default=100, help='Solves per transaction.')
+@click.option('--interval', default=0.2,
+              help='Seconds to wait when the queue is empty.')
+@click.option('--once', is_flag=True,
+              help='Stop once the queue is empty, or if another writer '
+              'holds the lock.')
+def ingest_solves(batch, interval, once):
+    """Save solves queued in SOLVE_QUEUE mode.
+
+    Run exactly one of these while SOLVE_QUEUE is on.
+    """
+    total = 0
+    while True:
+        count = ingest.drain_solves(batch)
+        if count:
+            total += count
+            continue
+        if once:
+            break
+        time.sleep(interval)
+    click.echo('{0} solves ingested.'.format(total))
+    if count is None:
+        click.echo('Stopped early: another writer holds the lock.')
+
+
+@cli.command('rebuild-scoreboard')
+def rebuild_scoreboard():
+    """Recompute team scores from the solve table."""
+    core.rebuild_scoreboard()
+
+
+@cli.command('bench-solves')
+@click.option('--teams', default=20, help='Number of teams to create.')
+@click.option('--challenges', default=20,
+              help='Number of challenges to create.')
+@click.option('--threads', default=8, help='Concurrent submitters.')
+@click.option('--queue', is_flag=True,
+              help='Queue solves for a writer thread, as SOLVE_QUEUE does.')
+def bench_solves(teams, challenges, threads, queue):
+    """Measure solve throughput against the configured database.
+
+    Creates (and afterwards deletes) temporary teams and challenges, so
+    don't run this against a live event.
+    """
+    results = bench.solve_throughput(teams, challenges, threads, queue)
+    click.echo('{solves} solves in {seconds:.2f}s ({rate:.1f}/sec), '
+               '{errors} database errors'.format(**results))
+    if queue:
+        click.echo('All saved after {saved:.2f}s'.format(**results))
+
+
+@cli.command('bench-load')
+@click.option('--url', help='Base URL of a running instance sharing this '
+              'database and Redis. By default the app is served '
+              'in-process.')
+@click.option('--users', default=50, help='Number of users to create.')
+@click.option('--teams', default=10, help='Number of teams to create.')
+@click.option('--challenges', default=10,
+              help='Number of challenges to create.')
+@click.option('--concurrency', default=16, help='Concurrent players.')
+@click.option('--seconds', default=30, help='How long to run for.')
+@click.option('--mix', default='flag=50,leaderboard=30,challenges=15,'
+              'login=4,download=1', help='Relative weight of each '
+              'operation.')
+@click.option('--fake-redis', is_flag=True,
+              help='Use fakeredis instead of Redis (in-process only).')
+@click.option('--save', type=click.Path(),
+              help='Save the results as a baseline.')
+@click.option('--compare', type=click.Path(exists=True),
+              help='Show changes from a saved baseline.')
+def bench_load(url, users, teams, challenges, concurrency, seconds, mix,
+               fake_redis, save, compare):
+    """Load test the API with a game-day mix of requests.
+
+    Creates (and afterwards deletes) temporary users, teams and
+    challenges, so don't run this against a live event.
+    """
+    try:
+        mix = loadtest.parse_mix(mix)
+    except ValueError as exc:
+        raise click.BadParameter(str(exc), param_hint='--mix')
+    app = current_app._get_current_object()
+    if fake_redis:
+        if url:
+            raise click.UsageError('--fake-redis only works in-process.')
+        import fakeredis
+        app.redis = fakeredis.FakeRedis()
+
+    server = None
+    if not url:
+        url, server = loadtest.serve_in_background(app)
+    bench.cleanup()
+    try:
+        players, flegs = bench.seed_players(users, teams, challenges)
+        results = loadtest.run(url, players, flegs, mix, seconds,
+                               concurrency)
+    finally:
+        bench.cleanup()
+        if server is not None:
+            server.shutdown()
+
+    baseline = loadtest.load_baseline(compare)['results'] if compare \
+        else None
+    for line in loadtest.format_report(results, baseline):
+        click.echo(line)
+    if save:
+        loadtest.save_baseline(save, results, {
+            'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0],
+            'redis': 'fakeredis' if fake_redis else 'redis',
+            'users': users, 'teams': teams, 'challenges': challenges,
+            'concurrency': concurrency, 'seconds': seconds, 'mix': mix,
+        })
+
+
+@cli.command('bench-passwords')
+@click.option('--seconds', default=5, help='How long to run for.')
+def bench_passwords(seconds):
+    """Measure Argon2 logins/sec for the configured cost."""
+    rate = passwords.benchmark(seconds)
+    click.echo('{0:.1f} logins/sec per core ({1})'.format(
+        rate, passwords.get_cost() or 'argon2 defaults'))
@@ -1,15 +1,18 @@
 """Core application logic."""
 from base64 import urlsafe_b64encode
-from argon2 import PasswordHasher
-from argon2.exceptions import VerificationError
 from datetime import datetime
-from flask import current_app
-from sqlalchemy.orm import joinedload, undefer_group
+from collections import namedtuple
+from flask import current_app, g
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from . import audit, cache, counters, passwords, ratelimit, scoring
 from ._compat import want_bytes
 from .ext import db
-from .models import Team, User, Challenge, Resource
+from .models import Team, User, Challenge, Resource, Solve
 import hashlib
+import json
 import os
+import time
 
 
 class CtfException(Exception):
@@ -18,6 +21,38 @@ class CtfException(Exception):
         self.message = message
 
 
+class RateLimitException(CtfException):
+
+    def __init__(self, message, retry_after):
+        super(RateLimitException, self).__init__(message)
+        self.retry_after = retry_after
+
+
+Identity = namedtuple('Identity', ['user_id', 'team_id', 'name'])
+
+IDENTITY_GENERATION_KEY = 'identity.generation'
+IDENTITY_CACHE_SIZE = 10000
+
+SCOREBOARD_CHANNEL = 'scoreboard'
+CHALLENGES_VERSION_KEY = 'challenges.version'
+RECENT_WRITE_KEY = 'recent-write.team.%d'
+
+# Solves waiting for ingest.drain_solves, in SOLVE_QUEUE mode
+SOLVE_QUEUE_KEY = 'solves.queue'
+# Set when a solve is queued and kept once it is saved, so duplicates are
+# caught without a query
+SOLVE_CLAIMED_KEY = 'solves.claimed.%d.%d'
+# Only matters if a queued solve is lost before the writer gets to it
+SOLVE_CLAIM_TIMEOUT = 3600
+SOLVE_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+DEFAULT_RATE_LIMITS = {
+    'team': {'limit': 10, 'window': 60},
+    # Opt-in: behind a reverse proxy every player has the proxy's address
+    'ip': None,
+}
+
+
 def ensure_active():
     fmt = '%Y-%m-%dT%H:%M:%S.%fZ'
     now = datetime.utcnow()
@@ -29,12 +64,109 @@ def ensure_active():
         raise CtfException('The competition has ended!')
 
 
+def read_session(team_id=None):
+    """Return the session read-only queries should use.
+
+    That is the replica, if configured, unless team_id's scoreboard changed
+    within the last REPLICA_MAX_LAG seconds; that team reads from the
+    primary so it sees its own writes.
+    """
+    if not db.has_replica():
+        return db.session
+    if team_id is not None and \
+            current_app.redis.exists(RECENT_WRITE_KEY % team_id):
+        return db.session
+    return db.read_session()
+
+
 def get_teams():
-    return (Team.query.options(undefer_group('scores'))
+    # Scores are kept current by ctf.scoring, so this is just a sort
+    return (read_session().query(Team)
             .order_by(Team.score.desc(), Team.last_solve, Team.id).all())
 
 
+def rebuild_scoreboard():
+    """Recompute every challenge's value and team's score from the solve
+    table.
+
+    add_fleg keeps Challenge.value, Team.score and Team.last_solve up to
+    date as solves come in; this is only needed to repair drift (e.g. after
+    editing solves by hand) or after changing the scoring engine.
+    """
+    scoring.recompute_values()
+    score = (db.select([db.func.coalesce(db.func.sum(Challenge.value), 0)])
+             .select_from(db.join(Solve, Challenge,
+                                  Solve.challenge_id == Challenge.id))
+             .where(Solve.team_id == Team.id).as_scalar())
+    last_solve = (db.select([db.func.max(Solve.earned_on)])
+                  .where(Solve.team_id == Team.id).as_scalar())
+    Team.query.update({Team.score: score, Team.last_solve: last_solve},
+                      synchronize_session=False)
+    db.session.commit()
+    scoreboard_changed()
+
+
+def get_rank(team):
+    """Return the team's 1-based position in the get_teams ordering."""
+    tie = Team.score == team.score
+    if team.last_solve is None:
+        tie &= Team.id < team.id
+    else:
+        tie &= ((Team.last_solve < team.last_solve) |
+                ((Team.last_solve == team.last_solve) & (Team.id < team.id)))
+    return Team.query.filter((Team.score > team.score) | tie).count() + 1
+
+
+def mark_recent_write(team_id):
+    """Have team_id read from the primary for the next REPLICA_MAX_LAG
+    seconds, so it sees what it just wrote."""
+    if db.has_replica():
+        lag = current_app.config.get('REPLICA_MAX_LAG', 5)
+        current_app.redis.set(RECENT_WRITE_KEY % team_id, 1, ex=lag)
+
+
+def scoreboard_changed(team=None, rescored=()):
+    """Invalidate cached leaderboards and tell scoreboard streams.
+
+    Given a team, streams are sent just that team's new name, points and
+    rank. Given the ids of teams rescored along with it (see ctf.scoring),
+    they are sent all of those teams, in rank order. Otherwise they are
+    told to reload everything.
+    """
+    cache.invalidate_leaderboard()
+    if team is not None:
+        mark_recent_write(team.id)
+    if rescored:
+        ids = set(rescored)
+        if team is not None:
+            ids.add(team.id)
+        # One query for every rank, rather than a get_rank per team
+        ranking = (db.session.query(Team.id, Team.name, Team.score)
+                   .order_by(Team.score.desc(), Team.last_solve, Team.id))
+        message = {'teams': [
+            {'id': id, 'name': name, 'points': score, 'rank': rank}
+            for rank, (id, name, score) in enumerate(ranking, 1)
+            if id in ids
+        ]}
+    elif team is not None:
+        message = {
+            'id': team.id,
+            'name': team.name,
+            'points': team.score,
+            'rank': get_rank(team),
+        }
+    else:
+        message = {'reload': True}
+    current_app.redis.publish(SCOREBOARD_CHANNEL, json.dumps(message))
+
+
 def get_team(id):
+    """Return a team for display; it may come from the replica."""
+    return read_session(id).query(Team).get(id)
+
+
+def load_team(id):
+    """Return a team from the primary, for requests that may modify it."""
     return Team.query.get(id)
 
 
@@ -46,30 +178,78 @@ def get_name():
     return current_app.config['CTF']['name']
 
 
-def check_prereqs(team, challenge):
-    if challenge.prerequisites is None:
+def load_challenge_graph():
+    """Compile the prerequisite graph into per-challenge bitmasks.
+
+    Challenge ids are used as bit positions; a challenge's mask has a bit set
+    for every challenge that must be solved before it is visible. Like the
+    fleg index, the map is replaced wholesale on reload.
+    """
+    graph = {}
+    for id, prerequisite_id in db.session.query(Challenge.id,
+                                                Challenge.prerequisite_id):
+        graph.setdefault(id, 0)
+        if prerequisite_id is not None:
+            # Challenge.prerequisites is backed by the prerequisite's own
+            # prerequisite_id column, which points at the dependent challenge
+            graph[prerequisite_id] = graph.get(prerequisite_id, 0) | 1 << id
+    current_app.challenge_graph = graph
+    return graph
+
+
+def get_challenge_graph():
+    check_challenges_version()
+    graph = getattr(current_app, 'challenge_graph', None)
+    if graph is None:
+        graph = load_challenge_graph()
+    return graph
+
+
+def solved_ids(team):
+    """Return the set of ids of every challenge the team has solved."""
+    return set(challenge_id for challenge_id, in
+               (read_session(team.id).query(Solve.challenge_id)
+                .filter(Solve.team_id == team.id)))
+
+
+def solved_mask(team):
+    """Return a bitmask of the ids of every challenge the team has solved."""
+    mask = 0
+    for challenge_id in solved_ids(team):
+        mask |= 1 << challenge_id
+    return mask
+
+
+def check_prereqs(team, challenge_id, solved=None):
+    required = get_challenge_graph().get(challenge_id, 0)
+    if not required:
         return True
-    else:
-        return challenge.prerequisites <= team.challenges
+    if solved is None:
+        solved = solved_mask(team)
+    return required & ~solved == 0
 
 
 def get_challenges(team):
-    all_challs = (Challenge.query.options(joinedload(Challenge.resources))
+    graph = get_challenge_graph()
+    solved = solved_mask(team) if any(graph.values()) else 0
+    all_challs = (read_session(team.id).query(Challenge)
+                  .options(joinedload(Challenge.resources))
                   .order_by(Challenge.points).all())
-    return list(filter(lambda c: check_prereqs(team, c), all_challs))
+    return [c for c in all_challs if check_prereqs(team, c.id, solved)]
 
 
 def get_challenge(team, id):
-    chal = Challenge.query.get(id)
-    if chal is None or not check_prereqs(team, chal):
+    chal = read_session(team.id).query(Challenge).get(id)
+    if chal is None or not check_prereqs(team, chal.id):
         return None
     else:
         return chal
 
 
 def get_resource(team, name):
-    resource = Resource.query.filter(Resource.name == name).first()
-    if resource is None or not check_prereqs(team, resource.challenge):
+    resource = (read_session(team.id).query(Resource)
+                .filter(Resource.name == name).first())
+    if resource is None or not check_prereqs(team, resource.challenge_id):
         return None
     else:
         return resource
@@ -79,23 +259,116 @@ def hash_fleg(fleg):
     return hashlib.sha256(want_bytes(fleg)).hexdigest()
 
 
+def load_fleg_index():
+    """Rebuild this process's fleg_hash -> (challenge id, value) map.
+
+    The value is as of the last load; with dynamic scoring it is not kept
+    up to date as solves come in. The map is replaced wholesale rather than
+    mutated, so readers never see a partially built index.
+    """
+    rows = db.session.query(Challenge.fleg_hash, Challenge.id,
+                            Challenge.value).all()
+    current_app.fleg_index = dict((h, (id, value))
+                                  for h, id, value in rows)
+    return current_app.fleg_index
+
+
+def check_challenges_version():
+    """Drop this process's challenge maps if the challenges have changed.
+
+    The version is read from Redis at most once per request; the maps are
+    rebuilt lazily by get_fleg_index and get_challenge_graph.
+    """
+    if g.get('challenges_checked'):
+        return
+    g.challenges_checked = True
+    version = int(current_app.redis.get(CHALLENGES_VERSION_KEY) or 0)
+    if version != getattr(current_app, 'challenges_version', None):
+        current_app.fleg_index = None
+        current_app.challenge_graph = None
+        current_app.challenges_version = version
+
+
+def challenges_changed():
+    """Reload our challenge maps and tell every other process to."""
+    current_app.challenges_version = \
+        current_app.redis.incr(CHALLENGES_VERSION_KEY)
+    load_fleg_index()
+    load_challenge_graph()
+
+
+def get_fleg_index():
+    check_challenges_version()
+    index = getattr(current_app, 'fleg_index', None)
+    if index is None:
+        index = load_fleg_index()
+    return index
+
+
 def create_session_key(user):
     token = urlsafe_b64encode(os.urandom(24)).decode('ascii')
     current_app.redis.set(u'api-token.%s' % token, user.id)
+    counters.incr('ctf_sessions_created_total')
     return token
 
 
-def user_for_token(token):
-    user_id = current_app.redis.get('api-token.%s' % token)
+def identity_for_token(token):
+    """Return the Identity for a session token, or None.
+
+    Identities are cached for the request in flask.g and for the process on
+    the app, for up to TOKEN_CACHE_TIMEOUT seconds. A process-cached entry is
+    only trusted if the identity generation in Redis has not moved since it
+    was cached, so a hit costs one Redis round trip and no SQL.
+    """
+    request_cache = g.setdefault('identities', {})
+    if token in request_cache:
+        return request_cache[token]
+
+    user_id, generation = current_app.redis.mget(
+        ['api-token.%s' % token, IDENTITY_GENERATION_KEY])
     if not user_id:
         return None
-    return User.query.filter_by(id=int(user_id)).first()
+    user_id = int(user_id)
+    generation = int(generation or 0)
+
+    process_cache = getattr(current_app, 'identity_cache', None)
+    if process_cache is None:
+        process_cache = current_app.identity_cache = {}
+    now = time.time()
+    cached = process_cache.get(token)
+    if cached and cached[1] == generation and cached[2] > now:
+        identity = cached[0]
+    else:
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+        identity = Identity(user.id, user.team_id, user.name)
+        if len(process_cache) >= IDENTITY_CACHE_SIZE:
+            process_cache.clear()
+        timeout = current_app.config.get('TOKEN_CACHE_TIMEOUT', 30)
+        process_cache[token] = (identity, generation, now + timeout)
+
+    request_cache[token] = identity
+    return identity
+
+
+def invalidate_identities():
+    """Invalidate every cached Identity, in every process."""
+    g.pop('identities', None)
+    current_app.redis.incr(IDENTITY_GENERATION_KEY)
+
+
+def user_for_token(token):
+    identity = identity_for_token(token)
+    if identity is None:
+        return None
+    return User.query.get(identity.user_id)
 
 
 def create_user(username, password):
     if User.query.filter(db.func.lower(User.name) == username.lower()).count():
         raise CtfException('That username is taken.')
-    pw_hash = PasswordHasher().hash(want_bytes(password))
+    pw_hash = passwords.hash_password(want_bytes(password))
     user = User(name=username, password=pw_hash)
     db.session.add(user)
     db.session.commit()
@@ -103,21 +376,17 @@ def create_user(username, password):
 
 
 def login(username, password):
-    ph = PasswordHasher()
     user = User.query.filter(db.func.lower(User.name) == username.lower()) \
         .first()
-    try:
-        if user:
-            if ph.verify(user.password, want_bytes(password)):
-                return user
-            else:
-                raise CtfException('Incorrect username or password.')
-        else:
-            # Defeat userame discovery
-            ph.verify('', '')
-    except VerificationError:
-        raise CtfException('Incorrect username or password.')
+    if user:
+        if passwords.verify_password(user.password, want_bytes(password)):
+            counters.incr('ctf_logins_total', {'result': 'success'})
+            return user
+    else:
+        # Defeat userame discovery
+        passwords.verify_password(passwords.dummy_hash(), want_bytes(password))
 
+    counters.incr('ctf_logins_total', {'result': 'failure'})
     raise CtfException('Incorrect username or password.')
 
 
@@ -130,6 +399,8 @@ def create_team(user, name):
     user.team = team
     db.session.add(team)
     db.session.commit()
+    scoreboard_changed(team)
+    invalidate_identities()
     return team
 
 
@@ -140,6 +411,7 @@ def rename_team(team, name):
     team.name = name
     db.session.add(team)
     db.session.commit()
+    scoreboard_changed(team)
 
 
 def create_invite(team, username):
@@ -164,27 +436,120 @@ def join_team(team_id, user):
     user.invites.remove(team)
     db.session.add(user)
     db.session.commit()
+    invalidate_identities()
 
 
 def leave_team(user):
     user.team = None
     db.session.add(user)
     db.session.commit()
+    invalidate_identities()
+
+
+def ensure_rate_limit(team, ip=None):
+    """Raise RateLimitException if the team or IP is submitting too fast.
+
+    Limits are read from CTF.rate_limits, e.g.
+    {"team": {"limit": 10, "window": 60}}; a scope set to null is not
+    limited.
+    """
+    limits = dict(DEFAULT_RATE_LIMITS)
+    limits.update(current_app.config['CTF'].get('rate_limits', {}))
+    scopes = [('team', 'team.%d' % team.id)]
+    if ip is not None:
+        scopes.append(('ip', 'ip.%s' % ip))
+    for scope, name in scopes:
+        limit = limits.get(scope)
+        if not limit:
+            continue
+        retry_after = ratelimit.hit('fleg.' + name, limit['limit'],
+                                    limit['window'])
+        if retry_after:
+            raise RateLimitException('You are submitting flags too quickly. '
+                                     'Try again in {0:d} seconds.'
+                                     .format(retry_after), retry_after)
+
+
+def enqueue_solve(team_id, challenge_id, earned_on):
+    """Queue a solve for the writer (see ctf.ingest), without touching
+    the database. Returns False if the team already has it, queued or
+    saved.
+    """
+    redis = current_app.redis
+    claimed = SOLVE_CLAIMED_KEY % (team_id, challenge_id)
+    if not redis.set(claimed, 1, nx=True, ex=SOLVE_CLAIM_TIMEOUT):
+        return False
+    redis.lpush(SOLVE_QUEUE_KEY, json.dumps({
+        'team': team_id,
+        'challenge': challenge_id,
+        'earned_on': earned_on.strftime(SOLVE_TIME_FORMAT),
+    }))
+    return True
+
+
+def add_fleg(fleg, team, ip=None, user_id=None):
+    fleg_hash = hash_fleg(fleg)
+    # Read now; a rollback would expire it
+    team_id = team.id
 
+    def submitted(outcome, challenge_id=None):
+        counters.incr('ctf_flag_submissions_total', {'result': outcome})
+        audit.log_submission(outcome, team_id, fleg_hash, ip, user_id,
+                             challenge_id)
 
-def add_fleg(fleg, team):
-    ensure_active()
-
-    fleg_hash = hash_fleg(fleg)
-    solved = Challenge.query.filter_by(fleg_hash=fleg_hash).first()
+    try:
+        ensure_active()
+    except CtfException:
+        submitted('inactive')
+        raise
+    try:
+        ensure_rate_limit(team, ip)
+    except RateLimitException:
+        submitted('rate_limited')
+        raise
+
+    # Wrong flegs are rejected without touching the database
+    match = get_fleg_index().get(fleg_hash)
+    if match is None:
+        submitted('incorrect')
+        raise CtfException('Nope.')  # fleg incorrect
+    challenge_id, value = match
 
+    now = datetime.utcnow()
+    if current_app.config.get('SOLVE_QUEUE', False):
+        # Right flegs don't touch it either; the writer skips solves it
+        # can't save, e.g. of challenges deleted since the index was loaded
+        if not enqueue_solve(team_id, challenge_id, now):
+            submitted('duplicate', challenge_id)
+            raise CtfException('You\'ve already entered that flag.')
+        submitted('correct', challenge_id)
+        counters.incr('ctf_solves_total', {'challenge': challenge_id})
+        # Never added to the session, just tells the caller what it was
+        # worth when the index was loaded
+        return Challenge(id=challenge_id, value=value)
+
+    solved = Challenge.query.get(challenge_id)
     if solved is None:
+        submitted('incorrect')
         raise CtfException('Nope.')  # fleg incorrect
-    elif solved in team.challenges:
+
+    # The solve table's primary key catches repeats, so we never have to
+    # load the team's solved challenges
+    db.session.add(Solve(team_id=team.id, challenge_id=solved.id,
+                         earned_on=now))
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        submitted('duplicate', solved.id)
         raise CtfException('You\'ve already entered that flag.')
 
-    team.challenges.add(solved)
+    team.last_solve = now
     db.session.add(team)
+    rescored = scoring.record_solves(solved.id, [team_id])
     db.session.commit()
+    scoreboard_changed(team, rescored)
+    submitted('correct', solved.id)
+    counters.incr('ctf_solves_total', {'challenge': solved.id})
 
     return solved
@@ -0,0 +1,111 @@
+"""Game-level counters and histograms, shared by every worker via Redis.
+
+Each sample is a field in one of two Redis hashes, so incrementing is a
+single HINCRBY (or one pipeline for a histogram) and every worker's counts
+land in the same place; /metrics renders them next to the per-process
+request metrics from ctf.instrument. Like those, they are only recorded
+with "INSTRUMENTATION": true.
+"""
+from flask import current_app
+from .instrument import BUCKETS, enabled
+import bisect
+import json
+
+
+COUNTERS_KEY = 'metrics.counters'
+HISTOGRAMS_KEY = 'metrics.histograms'
+
+# Name: (type, help, histogram buckets)
+METRICS = {
+    'ctf_flag_submissions_total': (
+        'counter', 'Flag submissions, by result.', None),
+    'ctf_solves_total': (
+        'counter', 'Solves, by challenge id.', None),
+    'ctf_logins_total': (
+        'counter', 'Login attempts, by result.', None),
+    'ctf_sessions_created_total': (
+        'counter', 'Session tokens handed out.', None),
+    'ctf_leaderboard_cache_total': (
+        'counter', 'Leaderboard cache lookups, by rendering and result '
+        '(hit, miss, or stale: served while another worker rebuilds).',
+        None),
+    'ctf_argon2_verify_seconds': (
+        'histogram', 'Password verify time, queueing included.',
+        (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)),
+    'ctf_leaderboard_build_seconds': (
+        'histogram', 'Time to build a leaderboard rendering.',
+        BUCKETS),
+}
+
+
+def field(name, labels, *extra):
+    return json.dumps([name, sorted((labels or {}).items())] + list(extra))
+
+
+def incr(name, labels=None, amount=1):
+    if enabled():
+        current_app.redis.hincrby(COUNTERS_KEY, field(name, labels), amount)
+
+
+def observe(name, seconds, labels=None):
+    if not enabled():
+        return
+    buckets = METRICS[name][2]
+    pipe = current_app.redis.pipeline(transaction=False)
+    # Buckets are stored individually and summed up when rendered
+    bucket = bisect.bisect_left(buckets, seconds)
+    if bucket < len(buckets):
+        pipe.hincrby(HISTOGRAMS_KEY, field(name, labels, bucket), 1)
+    pipe.hincrby(HISTOGRAMS_KEY, field(name, labels, 'count'), 1)
+    pipe.hincrbyfloat(HISTOGRAMS_KEY, field(name, labels, 'sum'), seconds)
+    pipe.execute()
+
+
+def escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def format_labels(labels, **extra):
+    pairs = list(labels) + sorted(extra.items())
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, escape(v)) for k, v in pairs)
+
+
+def format_counters():
+    """Render every worker's counters in the Prometheus text format."""
+    redis = current_app.redis
+    samples = {}
+    for key, value in redis.hgetall(COUNTERS_KEY).items():
+        name, labels = json.loads(key.decode('utf-8'))
+        samples.setdefault(name, {})[tuple(map(tuple, labels))] = int(value)
+    histograms = {}
+    for key, value in redis.hgetall(HISTOGRAMS_KEY).items():
+        name, labels, part = json.loads(key.decode('utf-8'))
+        series = histograms.setdefault(name, {}).setdefault(
+            tuple(map(tuple, labels)), {})
+        series[part] = float(value)
+
+    lines = []
+    for name in sorted(METRICS):
+        kind, help, buckets = METRICS[name]
+        lines += ['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, kind)]
+        if kind == 'counter':
+            for labels, value in sorted(samples.get(name, {}).items()):
+                lines.append('%s%s %d' % (name, format_labels(labels), value))
+            continue
+        for labels, series in sorted(histograms.get(name, {}).items()):
+            cumulative = 0
+            for i, bound in enumerate(buckets):
+                cumulative += int(series.get(i, 0))
+                lines.append('%s_bucket%s %d' % (
+                    name, format_labels(labels, le=bound), cumulative))
+            count = int(series.get('count', 0))
+            lines.append('%s_bucket%s %d' % (
+                name, format_labels(labels, le='+Inf'), count))
+            lines.append('%s_sum%s %f' % (
+                name, format_labels(labels), series.get('sum', 0)))
+            lines.append('%s_count%s %d' % (
+                name, format_labels(labels), count))
+    return '\n'.join(lines) + '\n'
@@ -1,7 +1,137 @@
 # -*- coding: utf-8 -*-
 """All our extensions"""
-from flask_sqlalchemy import SQLAlchemy
+from flask import current_app, g
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy
 from flask_wtf import CSRFProtect
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+
+# Applied to every new SQLite connection, overridable in CTF.database
+SQLITE_DEFAULTS = {
+    'journal_mode': 'WAL',
+    'busy_timeout': 5000,
+    'synchronous': 'NORMAL',
+}
+
+# SQLALCHEMY_BINDS key of the optional read replica
+REPLICA_BIND = 'replica'
+
+POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle')
+
+
+def get_database_config(app):
+    return app.config.get('CTF', {}).get('database', {})
+
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """Check a pooled connection is still alive before handing it out."""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        # The pool discards this connection and retries with a new one
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+def on_connect(statements):
+    def configure(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+    return configure
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    """Flask-SQLAlchemy, with engine tuning from CTF.database in ctf.json.
+
+    Any database takes pool_size, max_overflow, pool_timeout and
+    pool_recycle (without a pool_size, file-backed SQLite opens a new
+    connection per checkout). SQLite also takes journal_mode, busy_timeout
+    (ms) and synchronous, which default to WAL, 5000 and NORMAL. Other
+    databases take pre_ping (default true) and, on Postgres,
+    statement_timeout (ms).
+
+    If SQLALCHEMY_BINDS has a 'replica' entry, read_session() hands out a
+    session bound to it for read-only queries.
+    """
+
+    def init_app(self, app):
+        super(SQLAlchemy, self).init_app(app)
+        app.teardown_appcontext(self.remove_read_session)
+
+    def has_replica(self):
+        binds = current_app.config.get('SQLALCHEMY_BINDS') or {}
+        return REPLICA_BIND in binds
+
+    def read_session(self):
+        """Return a session for read-only queries.
+
+        That is a session on the replica, one per app context, if there is a
+        replica; otherwise the normal session. Objects loaded from it must
+        not be modified or added to the normal session.
+        """
+        if not self.has_replica():
+            return self.session
+        session = g.get('read_session')
+        if session is None:
+            engine = self.get_engine(bind=REPLICA_BIND)
+            # Without binds={}, every model would be bound to the primary
+            factory = self.create_session({'bind': engine, 'binds': {}})
+            session = g.read_session = factory()
+        return session
+
+    def remove_read_session(self, exc=None):
+        session = g.pop('read_session', None)
+        if session is not None:
+            session.close()
+
+    def apply_driver_hacks(self, app, info, options):
+        config = get_database_config(app)
+        if info.drivername == 'sqlite':
+            if info.database in (None, '', ':memory:'):
+                # Always a single StaticPool connection
+                config = {}
+            elif 'pool_size' in config:
+                # SQLite defaults to NullPool, which takes no pool options.
+                # A pooled connection is only used by one thread at a time.
+                options['poolclass'] = QueuePool
+                options.setdefault('connect_args', {})['check_same_thread'] = \
+                    False
+        for option in POOL_OPTIONS:
+            if option in config:
+                options[option] = config[option]
+        return super(SQLAlchemy, self).apply_driver_hacks(app, info, options)
+
+    def get_engine(self, app=None, bind=None):
+        engine = super(SQLAlchemy, self).get_engine(app, bind)
+        if not getattr(engine, 'ctf_configured', False):
+            self.configure_engine(self.get_app(app), engine)
+            engine.ctf_configured = True
+        return engine
+
+    def configure_engine(self, app, engine):
+        config = get_database_config(app)
+        statements = []
+        if engine.dialect.name == 'sqlite':
+            sqlite = dict(SQLITE_DEFAULTS)
+            sqlite.update(config)
+            for pragma in ('journal_mode', 'busy_timeout', 'synchronous'):
+                if sqlite.get(pragma) is not None:
+                    statements.append('PRAGMA %s = %s' %
+                                      (pragma, sqlite[pragma]))
+        else:
+            if config.get('pre_ping', True):
+                event.listen(engine.pool, 'checkout', ping_connection)
+            if (engine.dialect.name == 'postgresql' and
+                    config.get('statement_timeout')):
+                statements.append('SET statement_timeout = %d' %
+                                  int(config['statement_timeout']))
+        if statements:
+            event.listen(engine.pool, 'connect', on_connect(statements))
 
 
 csrf = CSRFProtect()
@@ -0,0 +1,160 @@
+"""Serving challenge resources.
+
+The views only authorize a download; send_resource moves the bytes. With
+USE_X_SENDFILE (Flask's own setting) the response only carries an
+X-Sendfile header for Apache or lighttpd to act on. With
+X_ACCEL_REDIRECT_PREFIX, it carries an X-Accel-Redirect to that internal
+nginx location, which must map onto the challenges directory (or
+RESOURCE_STORE, if set). Otherwise the file is streamed through
+wsgi.file_wrapper (sendfile, under most servers) with Range and
+conditional GET support.
+
+Downloads can also be authorized up front: signed_url gives a short-lived
+URL, signed with the app's secret key, that the download blueprint serves
+without looking at the session, the database or Redis. Download managers
+that open many connections per file then cost almost nothing to authorize.
+"""
+from flask import Blueprint, abort, current_app, request, safe_join, \
+    url_for, Response
+from itsdangerous import Signer, BadSignature, base64_decode, base64_encode
+from werkzeug.wsgi import wrap_file
+from .models import Resource
+from .setup import get_challenge_path, get_store_path, store_filename
+import json
+import mimetypes
+import os
+import time
+
+
+bp = Blueprint('files', __name__)
+
+
+# A year; signed URLs name the file's hash, so they change when it does
+IMMUTABLE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+
+def get_download_signer():
+    # Not the session signer's salt, so neither token passes for the other
+    return Signer(current_app.secret_key, salt='wrath-ctf-download')
+
+
+def signed_url(resource, **kwargs):
+    """Build a download URL for the resource that expires on its own.
+
+    Expiry is rounded up to a multiple of RESOURCE_URL_TIMEOUT seconds
+    (default 600), so a URL stays the same, and cacheable, for at least
+    that long.
+    """
+    timeout = current_app.config.get('RESOURCE_URL_TIMEOUT', 600)
+    expires = (int(time.time()) // timeout + 2) * timeout
+    directory = os.path.relpath(resource.path, get_challenge_path())
+    payload = json.dumps([resource.name, directory, resource.sha256,
+                          resource.size, resource.mtime, expires],
+                         separators=(',', ':'))
+    token = get_download_signer().sign(base64_encode(payload))
+    return url_for('files.download', token=token.decode('ascii'),
+                   name=resource.name, **kwargs)
+
+
+def resource_filename(resource):
+    """Return where the resource's file is, and the directory it's in."""
+    store = get_store_path()
+    if store is not None and resource.sha256 is not None:
+        return store_filename(resource.sha256), store
+    return safe_join(resource.path, resource.name), get_challenge_path()
+
+
+def current_hash(resource, filename, stat):
+    """Return the imported SHA-256 if it still describes filename.
+
+    Files in the store are named by their hash. Anywhere else, a file whose
+    size or mtime changed since the import may have different contents.
+    """
+    if resource.sha256 is None:
+        return None
+    if get_store_path() is not None and \
+            filename == store_filename(resource.sha256):
+        return resource.sha256
+    if (resource.size, resource.mtime) == (stat.st_size, stat.st_mtime):
+        return resource.sha256
+    return None
+
+
+def send_resource(resource, as_attachment=False, immutable=False):
+    """Serve the resource's file, or return None if it is missing.
+
+    immutable is ignored unless the file is still the imported version.
+    """
+    filename, root = resource_filename(resource)
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    sha256 = current_hash(resource, filename, stat)
+
+    mimetype = (mimetypes.guess_type(resource.name)[0] or
+                'application/octet-stream')
+    headers = {}
+    if as_attachment:
+        headers['Content-Disposition'] = \
+            'attachment; filename="%s"' % resource.name
+
+    config = current_app.config
+    accel_prefix = config.get('X_ACCEL_REDIRECT_PREFIX')
+    if accel_prefix:
+        location = os.path.relpath(filename, root)
+        headers['X-Accel-Redirect'] = '%s/%s' % (
+            accel_prefix.rstrip('/'), location.replace(os.sep, '/'))
+        rv = Response(mimetype=mimetype, headers=headers)
+    elif config.get('USE_X_SENDFILE'):
+        headers['X-Sendfile'] = os.path.abspath(filename)
+        rv = Response(mimetype=mimetype, headers=headers)
+    else:
+        f = open(filename, 'rb')
+        rv = Response(wrap_file(request.environ, f), mimetype=mimetype,
+                      headers=headers, direct_passthrough=True)
+        rv.content_length = stat.st_size
+        # Advertised up front so download managers know to split
+        rv.headers['Accept-Ranges'] = 'bytes'
+
+    if immutable and sha256 is not None:
+        rv.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    else:
+        # Downloads are per team, so only the browser may keep a copy, and
+        # it must revalidate (usually a cheap 304) before reusing it
+        rv.cache_control.private = True
+        rv.cache_control.no_cache = True
+    if sha256 is not None:
+        rv.last_modified = int(resource.mtime or stat.st_mtime)
+        rv.set_etag(sha256)
+    else:
+        # Changed (or never imported); still unique per version
+        rv.last_modified = int(stat.st_mtime)
+        rv.set_etag('%d-%d' % (int(stat.st_mtime), stat.st_size))
+    if rv.direct_passthrough:
+        return rv.make_conditional(request, accept_ranges=True,
+                                   complete_length=stat.st_size)
+    # The proxy handles ranges itself, but we can still answer a 304
+    return rv.make_conditional(request)
+
+
+@bp.route('/files/signed/<token>/<name>')
+def download(token, name):
+    """Serve a download authorized by signed_url."""
+    try:
+        payload = get_download_signer().unsign(token)
+        resource_name, directory, sha256, size, mtime, expires = \
+            json.loads(base64_decode(payload).decode('utf-8'))
+    except (BadSignature, ValueError):
+        abort(404)
+    if resource_name != name:
+        abort(404)
+    if expires < time.time():
+        abort(410)
+    # Never added to the session, just describes the file
+    resource = Resource(name=name, sha256=sha256, size=size, mtime=mtime,
+                        path=safe_join(get_challenge_path(), directory))
+    rv = send_resource(resource, as_attachment=True, immutable=True)
+    if rv is None:
+        abort(404)
+    return rv
@@ -1,9 +1,9 @@
 """ Native Front End """
 from functools import wraps
-from flask import Blueprint, request, session, abort, redirect, \
-                  render_template, url_for, flash, send_from_directory
+from flask import Blueprint, request, session, abort, redirect, g, \
+                  render_template, url_for, flash, Markup
 from flask_wtf.csrf import validate_csrf, ValidationError
-from . import core
+from . import cache, core, files
 from ._compat import urlparse
 from .core import CtfException
 from .forms import CreateForm, LoginForm, TeamForm, SubmitForm, InviteForm, \
@@ -33,20 +33,34 @@ def ensure_user(fn):
 
 
 def ensure_team(fn):
-    @ensure_user
     @wraps(fn)
-    def inner(user, *args, **kwargs):
-        if user.team is None:
+    def inner(*args, **kwargs):
+        identity = None
+        if 'key' in session:
+            identity = core.identity_for_token(session['key'])
+        if identity is None:
+            flash('You must be logged in to do that.', 'danger')
+            return redirect(url_for('.login', next=request.path), code=303)
+        team = None
+        if identity.team_id is not None:
+            team = core.load_team(identity.team_id)
+        if team is None:
             flash('You must be part of a team.', 'danger')
             return redirect(url_for('.home_page'), code=303)
-        return fn(user.team, *args, **kwargs)
+        g.identity = identity
+        return fn(team, *args, **kwargs)
     return inner
 
 
+def build_leaderboard():
+    return render_template('leaderboard.html', teams=core.get_teams())
+
+
 @bp.route('/')
 def home_page():
-    teams = core.get_teams()
-    return render_template('home.html', teams=teams)
+    leaderboard = cache.get_leaderboard('html', build_leaderboard)
+    return render_template('home.html',
+                           leaderboard=Markup(leaderboard.decode('utf-8')))
 
 
 @bp.route('/challenges/', methods=['GET', 'POST'])
@@ -59,19 +73,21 @@ def challenge_page(team):
         if fleg == 'V375BrzPaT':
             return snoopin()
         try:
-            solved = core.add_fleg(fleg, team)
+            solved = core.add_fleg(fleg, team, request.remote_addr,
+                                   g.identity.user_id)
         except CtfException as exc:
             flash(exc.message, 'danger')
         else:
             flash('Correct! You have earned {0:d} points for your team.'
-                  .format(solved.points), 'success')
+                  .format(solved.value), 'success')
     challenges = core.get_challenges(team)
     resource_urls = {}
     for c in challenges:
         for r in c.resources:
-            resource_urls[r.name] = url_for('.get_resource', name=r.name)
+            resource_urls[r.name] = files.signed_url(r)
     return render_template('challenge.html', challenges=challenges,
-                           team=team, form=form, resource_urls=resource_urls)
+                           solved=core.solved_ids(team), form=form,
+                           resource_urls=resource_urls)
 
 
 @bp.route('/teams/<int:id>/')
@@ -223,5 +239,7 @@ def get_resource(team, name):
     resource = core.get_resource(team, name)
     if resource is None:
         abort(404)
-    return send_from_directory(resource.path, resource.name,
-                               as_attachment=True)
+    rv = files.send_resource(resource, as_attachment=True)
+    if rv is None:
+        abort(404)
+    return rv
@@ -0,0 +1,139 @@
+"""The single writer for queued solves.
+
+With "SOLVE_QUEUE": true in ctf.json, core.add_fleg acknowledges a correct
+flag once the solve is pushed onto a Redis list, and never queries the
+database itself. One `flask ctf ingest-solves` process drains that list in
+batches, each written in a single transaction, so bursts of solves never
+contend for SQLite's write lock. Scores and the leaderboard lag behind by
+however long the writer takes to get to a solve.
+
+Each queued solve claims a key in Redis, which stops the team queueing it
+again. The writer keeps the claims of the solves it saves, so they stay
+duplicates, and drops the claims of solves it can't save (e.g. of a
+challenge deleted in the meantime). Solves are still checked against the
+solve table when written, so one queued again after the claims were lost
+(say, Redis was flushed) is acknowledged but not counted twice.
+
+A batch is moved to a processing list before it is written and only
+dropped from there after the commit. If the writer dies in between, the
+next run writes the batch again, skipping solves that were already saved.
+Each batch is written under a lock in Redis, so a second writer started by
+mistake just waits its turn instead of writing the same batch. A writer
+only ever releases its own lock, even if it held it past LOCK_TIMEOUT and
+another writer has taken it since.
+"""
+from flask import current_app
+from datetime import datetime
+from . import core, scoring
+from .ext import db
+from .models import Challenge, Solve, Team
+import json
+import uuid
+
+
+PROCESSING_KEY = 'solves.queue.processing'
+LOCK_KEY = 'solves.queue.lock'
+# Far longer than a batch takes; only matters if a writer dies holding it
+LOCK_TIMEOUT = 60
+# Deletes the lock only if it still holds our token
+RELEASE_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def take_batch(batch_size):
+    """Return the unfinished batch, if any, or move a new one into it."""
+    redis = current_app.redis
+    items = redis.lrange(PROCESSING_KEY, 0, -1)
+    if items:
+        return items
+    pipe = redis.pipeline()
+    for _ in range(batch_size):
+        pipe.rpoplpush(core.SOLVE_QUEUE_KEY, PROCESSING_KEY)
+    return [item for item in pipe.execute() if item is not None]
+
+
+def drain_solves(batch_size=100):
+    """Save one batch of queued solves, returning how many were queued.
+
+    Returns None without doing anything if another writer holds the lock.
+    """
+    redis = current_app.redis
+    token = uuid.uuid4().hex
+    if not redis.set(LOCK_KEY, token, nx=True, ex=LOCK_TIMEOUT):
+        return None
+    try:
+        return write_batch(batch_size)
+    finally:
+        redis.eval(RELEASE_LOCK, 1, LOCK_KEY, token)
+
+
+def write_batch(batch_size):
+    items = take_batch(batch_size)
+    if not items:
+        return 0
+
+    solves = {}
+    for item in items:
+        data = json.loads(item.decode('utf-8'))
+        key = (data['team'], data['challenge'])
+        earned_on = datetime.strptime(data['earned_on'],
+                                      core.SOLVE_TIME_FORMAT)
+        # If it was somehow queued twice, the first one counts
+        if key not in solves or earned_on < solves[key]:
+            solves[key] = earned_on
+
+    team_ids = set(team_id for team_id, _ in solves)
+    challenge_ids = set(challenge_id for _, challenge_id in solves)
+    saved = set(db.session.query(Solve.team_id, Solve.challenge_id)
+                .filter(Solve.team_id.in_(team_ids),
+                        Solve.challenge_id.in_(challenge_ids)))
+    known = set(challenge_id for challenge_id, in
+                db.session.query(Challenge.id)
+                .filter(Challenge.id.in_(challenge_ids)))
+    teams = dict((team.id, team) for team in
+                 Team.query.filter(Team.id.in_(team_ids)))
+
+    solvers = {}
+    for (team_id, challenge_id), earned_on in sorted(solves.items(),
+                                                     key=lambda s: s[1]):
+        if ((team_id, challenge_id) in saved or team_id not in teams or
+                challenge_id not in known):
+            continue
+        db.session.add(Solve(team_id=team_id, challenge_id=challenge_id,
+                             earned_on=earned_on))
+        solvers.setdefault(challenge_id, []).append(team_id)
+        team = teams[team_id]
+        # Tie-breaks use the time of the flag, not of this write
+        team.last_solve = max(team.last_solve or earned_on, earned_on)
+    db.session.flush()
+    rescored = set()
+    for challenge_id, solver_ids in sorted(solvers.items()):
+        # One rescore per challenge, however many of its solves are here
+        rescored.update(scoring.record_solves(challenge_id, solver_ids))
+    db.session.commit()
+
+    redis = current_app.redis
+    pipe = redis.pipeline()
+    pipe.delete(PROCESSING_KEY)
+    for key in solves:
+        claimed = core.SOLVE_CLAIMED_KEY % key
+        # Saved solves keep their claim for good; dropped ones give it up
+        if key in saved or key[0] in solvers.get(key[1], ()):
+            pipe.persist(claimed)
+        else:
+            pipe.delete(claimed)
+    pipe.execute()
+
+    solver_ids = set(t for ids in solvers.values() for t in ids)
+    if rescored:
+        for team_id in solver_ids:
+            core.mark_recent_write(team_id)
+        core.scoreboard_changed(rescored=rescored | solver_ids)
+    else:
+        for team_id in solver_ids:
+            core.scoreboard_changed(teams[team_id])
+    return len(items)
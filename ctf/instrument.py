@@ -0,0 +1,243 @@
+"""Opt-in per-request instrumentation.
+
+With "INSTRUMENTATION": true in ctf.json, every request records its wall
+time, SQL statement count and time, Redis command count and time, and time
+spent in Argon2. They are reported:
+
+- on the response, as a Server-Timing header (shown in browser devtools);
+- at /metrics, in the Prometheus text format, summed per endpoint for this
+  process (set METRICS_TOKEN to require "Authorization: Bearer <token>"),
+  followed by the process's Argon2 pool queue and the game counters from
+  ctf.counters;
+- in the log, for requests slower than SLOW_REQUEST_THRESHOLD ms
+  (default 500).
+"""
+from flask import Blueprint, Response, abort, current_app, g, \
+    has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import bisect
+import logging
+import threading
+import time
+
+
+bp = Blueprint('instrument', __name__)
+
+# Prometheus' default buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+KINDS = ('sql', 'redis', 'argon2')
+
+# Outside the "ctf" tree on purpose: Flask 0.12 turns off propagation on
+# the app logger (named after the package), and its own handler only shows
+# errors, so warnings logged under "ctf." would go nowhere
+logger = logging.getLogger('wrath_ctf.instrument')
+
+_lock = threading.Lock()
+
+
+def enabled():
+    return current_app.config.get('INSTRUMENTATION', False)
+
+
+def record(kind, seconds, count=1):
+    """Add to the current request's totals for kind, if instrumented."""
+    if not has_app_context():
+        return
+    metrics = g.get('metrics')
+    if metrics is not None:
+        metrics[kind][0] += count
+        metrics[kind][1] += seconds
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('query_start', []).append(time.time())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    starts = conn.info.get('query_start')
+    if starts:
+        record('sql', time.time() - starts.pop())
+
+
+def timed(kind, func, count=lambda *args: 1):
+    def inner(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(kind, time.time() - start, count(*args))
+    return inner
+
+
+def instrument_redis(client):
+    """Count and time the commands sent by a Redis client, pipelines
+    included."""
+    if getattr(client, 'ctf_instrumented', False):
+        return
+    make_pipeline = client.pipeline
+
+    def pipeline(*args, **kwargs):
+        pipe = make_pipeline(*args, **kwargs)
+        pipe.execute = timed('redis', pipe.execute,
+                             lambda *args: len(pipe.command_stack))
+        return pipe
+
+    client.execute_command = timed('redis', client.execute_command)
+    client.pipeline = pipeline
+    client.ctf_instrumented = True
+
+
+def start_request():
+    if not enabled():
+        return
+    # Tests and tools may swap app.redis after the app is created
+    instrument_redis(current_app.redis)
+    g.metrics = dict((kind, [0, 0.0]) for kind in KINDS)
+    g.metrics_start = time.time()
+
+
+def finish_request(response):
+    metrics = g.pop('metrics', None)
+    if metrics is None:
+        return response
+    elapsed = time.time() - g.metrics_start
+
+    timings = ['app;dur=%.1f' % (elapsed * 1000)]
+    for kind in KINDS:
+        count, seconds = metrics[kind]
+        if count:
+            timings.append('%s;desc="count=%d";dur=%.1f' %
+                           (kind, count, seconds * 1000))
+    response.headers['Server-Timing'] = ', '.join(timings)
+    tally(metrics, response.status_code, elapsed)
+    return response
+
+
+def abort_request(exc):
+    """Count requests that raised, which skip after_request hooks."""
+    metrics = g.pop('metrics', None)
+    if metrics is not None:
+        tally(metrics, 500, time.time() - g.metrics_start)
+
+
+def tally(metrics, status, elapsed):
+    """Add a finished request to this process's totals, and log it if it
+    was slow."""
+    endpoint = request.endpoint or 'unknown'
+    with _lock:
+        totals = current_app.request_metrics.setdefault(endpoint, {
+            'statuses': {},
+            'buckets': [0] * len(BUCKETS),
+            'seconds': 0.0,
+            'sql': [0, 0.0], 'redis': [0, 0.0], 'argon2': [0, 0.0],
+        })
+        statuses = totals['statuses']
+        statuses[status] = statuses.get(status, 0) + 1
+        bucket = bisect.bisect_left(BUCKETS, elapsed)
+        if bucket < len(BUCKETS):
+            totals['buckets'][bucket] += 1
+        totals['seconds'] += elapsed
+        for kind in KINDS:
+            totals[kind][0] += metrics[kind][0]
+            totals[kind][1] += metrics[kind][1]
+
+    threshold = current_app.config.get('SLOW_REQUEST_THRESHOLD', 500)
+    if elapsed * 1000 >= threshold:
+        logger.warning(
+            'Slow request: %s %s (%s) took %.0fms; SQL: %d in %.0fms, '
+            'Redis: %d in %.0fms, Argon2: %.0fms', request.method,
+            request.path, endpoint, elapsed * 1000, metrics['sql'][0],
+            metrics['sql'][1] * 1000, metrics['redis'][0],
+            metrics['redis'][1] * 1000, metrics['argon2'][1] * 1000)
+
+
+def format_metrics(request_metrics, pool_stats=None):
+    """Render per-endpoint totals, and the Argon2 pool's queue stats from
+    passwords.stats, in the Prometheus text format."""
+    lines = [
+        '# HELP ctf_requests_total Requests handled, by endpoint and status.',
+        '# TYPE ctf_requests_total counter',
+    ]
+    for endpoint, totals in sorted(request_metrics.items()):
+        for status, n in sorted(totals['statuses'].items()):
+            lines.append('ctf_requests_total{endpoint="%s",status="%d"} %d'
+                         % (endpoint, status, n))
+
+    lines += [
+        '# HELP ctf_request_duration_seconds Request wall time.',
+        '# TYPE ctf_request_duration_seconds histogram',
+    ]
+    for endpoint, totals in sorted(request_metrics.items()):
+        count = sum(totals['statuses'].values())
+        cumulative = 0
+        for bound, n in zip(BUCKETS, totals['buckets']):
+            cumulative += n
+            lines.append('ctf_request_duration_seconds_bucket'
+                         '{endpoint="%s",le="%s"} %d'
+                         % (endpoint, bound, cumulative))
+        lines.append('ctf_request_duration_seconds_bucket'
+                     '{endpoint="%s",le="+Inf"} %d' % (endpoint, count))
+        lines.append('ctf_request_duration_seconds_sum{endpoint="%s"} %f'
+                     % (endpoint, totals['seconds']))
+        lines.append('ctf_request_duration_seconds_count{endpoint="%s"} %d'
+                     % (endpoint, count))
+
+    for kind, calls in (('sql', 'SQL statements'),
+                        ('redis', 'Redis commands'),
+                        ('argon2', 'Argon2 hashes and verifies')):
+        for i, (metric, help) in enumerate((
+                ('calls_total', '%s run by requests.' % calls),
+                ('seconds_total', 'Time requests spent on %s.' % calls))):
+            name = 'ctf_%s_%s' % (kind, metric)
+            lines += ['# HELP %s %s' % (name, help),
+                      '# TYPE %s counter' % name]
+            for endpoint, totals in sorted(request_metrics.items()):
+                lines.append('%s{endpoint="%s"} %s'
+                             % (name, endpoint, totals[kind][i]))
+
+    if pool_stats is not None:
+        for name, kind, help, value in (
+                ('ctf_argon2_pool_queued', 'gauge',
+                 'Argon2 calls waiting on or running in the pool.',
+                 pool_stats['queued']),
+                ('ctf_argon2_pool_queued_peak', 'gauge',
+                 'Most Argon2 calls ever queued at once.',
+                 pool_stats['peak']),
+                ('ctf_argon2_pool_completed_total', 'counter',
+                 'Argon2 calls finished by the pool.',
+                 pool_stats['completed'])):
+            lines += ['# HELP %s %s' % (name, help),
+                      '# TYPE %s %s' % (name, kind),
+                      '%s %d' % (name, value)]
+    return '\n'.join(lines) + '\n'
+
+
+@bp.route('/metrics')
+def metrics():
+    if not enabled():
+        abort(404)
+    token = current_app.config.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != 'Bearer ' + token:
+        abort(403)
+    # Imported here since both of them use this module
+    from . import counters, passwords
+    with _lock:
+        body = format_metrics(current_app.request_metrics,
+                              dict(passwords.stats))
+    body += counters.format_counters()
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    app.request_metrics = {}
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(abort_request)
+    if not event.contains(Engine, 'before_cursor_execute',
+                          before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    app.register_blueprint(bp)
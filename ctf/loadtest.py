@@ -0,0 +1,246 @@
+"""Load testing an instance over HTTP with a game-day traffic mix.
+
+Seeded players (see bench.seed_players) hit the JSON API from several
+threads, each picking its next operation at random by weight, and every
+request's latency is recorded per operation. Results can be saved as a
+baseline and compared with later runs.
+"""
+from .bench import BENCH_PASSWORD
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from urllib.parse import urlparse
+from werkzeug.serving import make_server, WSGIRequestHandler
+import bisect
+import json
+import math
+import random
+import threading
+import time
+
+
+DEFAULT_MIX = {
+    'flag': 50,
+    'leaderboard': 30,
+    'challenges': 15,
+    'login': 4,
+    'download': 1,
+}
+
+# Share of flag submissions that use a real fleg rather than a guess
+REAL_FLEG_RATIO = 0.05
+
+
+def parse_mix(text):
+    """Parse e.g. 'flag=50,leaderboard=30' into operation weights."""
+    mix = {}
+    for part in text.split(','):
+        op, _, weight = part.partition('=')
+        op = op.strip()
+        if op not in DEFAULT_MIX:
+            raise ValueError('Unknown operation %s' % op)
+        mix[op] = float(weight or 1)
+    return mix
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+class Player(object):
+    """A seeded user on its own keep-alive connection.
+
+    Each operation returns the response status, or None if there was
+    nothing to do.
+    """
+
+    def __init__(self, base_url, username, key, flegs):
+        url = urlparse(base_url)
+        connection = HTTPSConnection if url.scheme == 'https' \
+            else HTTPConnection
+        self.conn = connection(url.hostname, url.port, timeout=30)
+        self.username = username
+        self.key = key
+        self.flegs = flegs
+        self.downloads = []
+
+    def request(self, method, path, data=None, auth=True):
+        headers = {}
+        body = None
+        if auth:
+            headers['X-Session-Key'] = self.key
+        if data is not None:
+            headers['Content-Type'] = 'application/json'
+            body = json.dumps(data)
+        try:
+            self.conn.request(method, path, body, headers)
+            rv = self.conn.getresponse()
+            return rv.status, rv.read()
+        except Exception:
+            # Start afresh on the next request
+            self.conn.close()
+            raise
+
+    def flag(self):
+        if self.flegs and random.random() < REAL_FLEG_RATIO:
+            fleg = random.choice(self.flegs)
+        else:
+            fleg = 'flag{%08x}' % random.getrandbits(32)
+        return self.request('POST', '/api/flags/', {'flag': fleg})[0]
+
+    def leaderboard(self):
+        return self.request('GET', '/api/teams/', auth=False)[0]
+
+    def challenges(self):
+        status, data = self.request('GET', '/api/challenges/')
+        if status == 200:
+            challenges = json.loads(data.decode('utf-8'))['challenges']
+            self.downloads = [url for c in challenges
+                              for url in c['resource_urls'].values()]
+        return status
+
+    def login(self):
+        return self.request('POST', '/api/sessions/', {
+            'username': self.username,
+            'password': BENCH_PASSWORD,
+        }, auth=False)[0]
+
+    def download(self):
+        # Download links come from the challenge list
+        if not self.downloads:
+            return None
+        return self.request('GET', random.choice(self.downloads),
+                            auth=False)[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def run(base_url, players, flegs, mix=None, seconds=30, concurrency=8):
+    """Replay the mix against base_url for the given number of seconds.
+
+    players is a list of (username, signed session key), as returned by
+    bench.seed_players; each thread plays one of them. Returns the
+    summary from summarize().
+    """
+    mix = mix or DEFAULT_MIX
+    ops = sorted(op for op in mix if mix[op] > 0)
+    cumulative = []
+    total = 0
+    for op in ops:
+        total += mix[op]
+        cumulative.append(total)
+
+    latencies = dict((op, []) for op in ops)
+    statuses = dict((op, {}) for op in ops)
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+
+    def worker(username, key):
+        player = Player(base_url, username, key, flegs)
+        while time.time() < deadline:
+            op = ops[bisect.bisect(cumulative, random.random() * total)]
+            start = time.time()
+            try:
+                status = getattr(player, op)()
+            except (IOError, OSError, HTTPException):
+                status = 'error'
+            elapsed = time.time() - start
+            if status is None:
+                continue
+            with lock:
+                latencies[op].append(elapsed)
+                statuses[op][status] = statuses[op].get(status, 0) + 1
+        player.close()
+
+    start = time.time()
+    pool = [threading.Thread(target=worker, args=players[i % len(players)])
+            for i in range(concurrency)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return summarize(latencies, statuses, time.time() - start)
+
+
+def summarize(latencies, statuses, elapsed):
+    """Reduce raw latencies (seconds) and status counts to, per operation
+    and in total, the request count and rate, errors (failed connections
+    and 5xx responses), status counts and p50/p95/p99 in milliseconds."""
+    def stats(times, counts):
+        times = sorted(times)
+        result = {
+            'requests': len(times),
+            'rate': len(times) / elapsed,
+            'errors': sum(n for status, n in counts.items()
+                          if status == 'error' or status >= 500),
+            'statuses': dict((str(s), n) for s, n in counts.items()),
+        }
+        for pct in (50, 95, 99):
+            value = percentile(times, pct)
+            result['p%d' % pct] = None if value is None else value * 1000
+        return result
+
+    results = dict((op, stats(latencies[op], statuses[op]))
+                   for op in latencies)
+    all_counts = {}
+    for counts in statuses.values():
+        for status, n in counts.items():
+            all_counts[status] = all_counts.get(status, 0) + n
+    results['total'] = stats([t for times in latencies.values()
+                              for t in times], all_counts)
+    return results
+
+
+def save_baseline(filename, results, settings):
+    with open(filename, 'w') as f:
+        json.dump({'settings': settings, 'results': results}, f,
+                  indent=2, sort_keys=True)
+
+
+def load_baseline(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def format_report(results, baseline=None):
+    """Return report lines, with changes from a baseline's results."""
+    columns = ('requests', 'rate', 'p50', 'p95', 'p99', 'errors')
+    lines = ['%-12s %16s %16s %16s %16s %16s %8s' % (
+        ('operation', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+         'errors'))]
+    ops = sorted(op for op in results if op != 'total') + ['total']
+    for op in ops:
+        cells = []
+        for column in columns[:-1]:
+            value = results[op][column]
+            if value is None:
+                cell = '-'
+            else:
+                cell = ('%d' if column == 'requests' else '%.1f') % value
+            before = (baseline or {}).get(op, {}).get(column)
+            if value is not None and before:
+                cell += ' (%+.0f%%)' % ((value - before) * 100.0 / before)
+            cells.append(cell)
+        lines.append('%-12s %16s %16s %16s %16s %16s %8d' % (
+            tuple([op] + cells + [results[op]['errors']])))
+    return lines
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def serve_in_background(app):
+    """Serve app on a free local port from a thread, for load testing
+    without a separate server process. Returns (base URL, server); call
+    server.shutdown() when done."""
+    server = make_server('127.0.0.1', 0, app, threaded=True,
+                         request_handler=QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:%d' % server.server_port, server
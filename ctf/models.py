@@ -1,5 +1,4 @@
 from .ext import db
-from sqlalchemy.orm import column_property
 
 
 invite_table = \
@@ -15,6 +14,9 @@ class Solve(db.Model):
     challenge_id = db.Column(db.Integer, db.ForeignKey('challenge.id'),
                              primary_key=True)
     earned_on = db.Column(db.DateTime, server_default=db.func.now())
+    __table_args__ = (
+        db.Index('ix_solve_team_earned', 'team_id', 'earned_on'),
+    )
 
 
 class User(db.Model):
@@ -27,13 +29,22 @@ class User(db.Model):
     invites = db.relationship('Team', secondary=invite_table)
 
 
+# Names are looked up case-insensitively, and must be unique that way too
+db.Index('ix_user_name_lower', db.func.lower(User.name), unique=True)
+
+
+def initial_value(context):
+    # Unsolved, a challenge is worth its points under any scoring engine
+    return context.current_parameters.get('points')
+
+
 class Challenge(db.Model):
     __tablename__ = "challenge"
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(128), unique=True)
     description = db.Column(db.Text)
     category = db.Column(db.String(123))
-    points = db.Column(db.Integer)
+    points = db.Column(db.Integer, index=True)
     fleg_hash = db.Column(db.String(128), unique=True)
     teams_solved = db.relationship('Team', secondary='solve',
                                    backref='challenge', collection_class=set)
@@ -41,12 +52,17 @@ class Challenge(db.Model):
     prerequisites = db.relationship('Challenge', collection_class=set)
     resources = db.relationship('Resource', backref='challenge')
 
+    # Materialized by ctf.scoring, rebuilt by core.rebuild_scoreboard
+    solve_count = db.Column(db.Integer, nullable=False, default=0,
+                            server_default='0')
+    value = db.Column(db.Integer, default=initial_value)
+
     def chal_info(self):
         return {"id": self.id,
                 "title": self.title,
                 "description": self.description,
                 "category": self.category,
-                "points": self.points,
+                "points": self.value,
                 "resources": [r.name for r in self.resources]}
 
 
@@ -58,21 +74,28 @@ class Team(db.Model):
     challenges = db.relationship('Challenge', secondary='solve',
                                  backref='team', collection_class=set)
 
-    score = column_property(
-        db.select([db.func.coalesce(db.func.sum(Challenge.points), 0)])
-        .select_from(db.join(Solve, Challenge,
-                             Solve.challenge_id == Challenge.id))
-        .where(Solve.team_id == id),
-        deferred=True,
-        group='scores',
-    )
+    # Materialized by core.add_fleg, rebuilt by core.rebuild_scoreboard
+    score = db.Column(db.Integer, nullable=False, default=0,
+                      server_default='0')
+    last_solve = db.Column(db.DateTime)
 
-    last_solve = column_property(
-        db.select([db.func.max(Solve.earned_on)])
-        .select_from(Solve).where(Solve.team_id == id),
-        deferred=True,
-        group='scores',
-    )
+
+db.Index('ix_team_rank', Team.score.desc(), Team.last_solve, Team.id)
+db.Index('ix_team_name_lower', db.func.lower(Team.name), unique=True)
+
+
+class Submission(db.Model):
+    """A flag submission, archived from the Redis stream by ctf.audit."""
+    __tablename__ = 'submission'
+    # The stream entry id, so archiving the same entry twice is a no-op
+    id = db.Column(db.String(32), primary_key=True)
+    submitted_at = db.Column(db.DateTime, nullable=False)
+    team_id = db.Column(db.Integer, index=True)
+    user_id = db.Column(db.Integer)
+    ip = db.Column(db.String(45))
+    challenge_id = db.Column(db.Integer)
+    hash_prefix = db.Column(db.String(16))
+    outcome = db.Column(db.String(16))
 
 
 class Resource(db.Model):
@@ -80,4 +103,9 @@ class Resource(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), unique=True)
     path = db.Column(db.String(128))
+    # Hex SHA-256 of the file, computed at import and used as its ETag.
+    # The size and mtime let re-imports skip hashing unchanged files.
+    sha256 = db.Column(db.String(64))
+    size = db.Column(db.BigInteger)
+    mtime = db.Column(db.Float)
     challenge_id = db.Column(db.Integer, db.ForeignKey('challenge.id'))
@@ -0,0 +1,136 @@
+"""Argon2 password hashing, optionally offloaded to a process pool.
+
+Costs and pool size come from CTF.argon2 in ctf.json, e.g.
+
+    "argon2": {"time_cost": 2, "memory_cost": 512, "parallelism": 2,
+               "workers": 4, "max_queue": 16}
+
+With no "workers" (the default) hashing runs in the calling thread. Otherwise
+every hash and verify goes through a pool of that many processes, with at
+most "max_queue" calls waiting on or running in it at once; further callers
+block until a slot frees up.
+
+A server can instead set executor to a function(func, args) that runs the
+call somewhere else and returns its result; serve.py uses gevent's
+threadpool so hashing never blocks the event loop. "workers" then has no
+effect on where hashing runs.
+"""
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError
+from flask import current_app
+from . import counters, instrument
+from multiprocessing import Pool
+import os
+import threading
+import time
+
+
+COST_KEYS = ('time_cost', 'memory_cost', 'parallelism', 'hash_len',
+             'salt_len')
+
+# Current and peak number of calls waiting on or running in the pool
+stats = {'queued': 0, 'peak': 0, 'completed': 0}
+
+# See the module docstring
+executor = None
+
+_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+_slots = None
+_dummy_hashes = {}
+
+
+def get_config():
+    return current_app.config['CTF'].get('argon2', {})
+
+
+def get_cost():
+    config = get_config()
+    return dict((k, config[k]) for k in COST_KEYS if k in config)
+
+
+def _hash(cost, password):
+    return PasswordHasher(**cost).hash(password)
+
+
+def _verify(hash, password):
+    try:
+        return PasswordHasher().verify(hash, password)
+    except VerificationError:
+        return False
+
+
+def _get_pool(workers, max_queue):
+    global _pool, _pool_pid, _slots
+    with _lock:
+        # Pools don't survive a fork, so each worker process gets its own
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = Pool(workers)
+            _pool_pid = os.getpid()
+            _slots = threading.BoundedSemaphore(max_queue)
+        return _pool, _slots
+
+
+def _run(func, *args):
+    start = time.time()
+    try:
+        return _call(func, *args)
+    finally:
+        instrument.record('argon2', time.time() - start)
+
+
+def _call(func, *args):
+    if executor is not None:
+        return executor(func, args)
+    config = get_config()
+    workers = config.get('workers', 0)
+    if not workers:
+        return func(*args)
+
+    pool, slots = _get_pool(workers, config.get('max_queue', workers * 4))
+    with _lock:
+        stats['queued'] += 1
+        stats['peak'] = max(stats['peak'], stats['queued'])
+    slots.acquire()
+    try:
+        return pool.apply(func, args)
+    finally:
+        slots.release()
+        with _lock:
+            stats['queued'] -= 1
+            stats['completed'] += 1
+
+
+def hash_password(password):
+    return _run(_hash, get_cost(), password)
+
+
+def verify_password(hash, password):
+    """Return True if password matches hash, False otherwise."""
+    start = time.time()
+    try:
+        return _run(_verify, hash, password)
+    finally:
+        counters.observe('ctf_argon2_verify_seconds', time.time() - start)
+
+
+def dummy_hash():
+    """A hash with the configured cost, for verifying against nonexistent
+    users so they take as long to reject as real ones."""
+    cost = get_cost()
+    key = tuple(sorted(cost.items()))
+    if key not in _dummy_hashes:
+        _dummy_hashes[key] = _hash(cost, os.urandom(16))
+    return _dummy_hashes[key]
+
+
+def benchmark(seconds=5):
+    """Return logins (verifications) per second on one core."""
+    hash = _hash(get_cost(), b'benchmark')
+    count = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        _verify(hash, b'benchmark')
+        count += 1
+    return count / (time.time() - start)
@@ -0,0 +1,30 @@
+"""Sliding window rate limiting, kept in app.redis."""
+from flask import current_app
+import math
+import time
+import uuid
+
+
+def hit(name, limit, window):
+    """Record an attempt against the limit called name.
+
+    Returns 0 if the attempt is allowed, otherwise the number of seconds until
+    the oldest attempt leaves the window. Rejected attempts are not counted.
+    """
+    redis = current_app.redis
+    key = 'ratelimit.%s' % name
+    now = time.time()
+    member = uuid.uuid4().hex
+
+    pipe = redis.pipeline()
+    pipe.zremrangebyscore(key, '-inf', now - window)
+    pipe.zadd(key, {member: now})
+    pipe.zcard(key)
+    pipe.zrange(key, 0, 0, withscores=True)
+    pipe.expire(key, int(math.ceil(window)) + 1)
+    _, _, count, oldest, _ = pipe.execute()
+
+    if count <= limit:
+        return 0
+    redis.zrem(key, member)
+    return max(1, int(math.ceil(oldest[0][1] + window - now)))
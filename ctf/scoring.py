@@ -0,0 +1,114 @@
+"""Challenge values and team scores.
+
+A challenge's points are what it is worth before anyone solves it; its
+value is what it is worth now, decided by the scoring engine set by
+CTF.scoring in ctf.json:
+
+- {"type": "static"} (the default): the value is always the points.
+- {"type": "decay", "minimum": 100, "decay": 30}: the first solver gets
+  the points, and the value then falls along a parabola with each further
+  solve, reaching minimum once decay more teams have solved it (that is,
+  at solve decay + 1).
+
+Every solver of a challenge scores its current value, so when it changes,
+teams that solved it earlier are rescored too. Challenge.solve_count,
+Challenge.value and Team.score are all kept up to date as solves come in,
+with one UPDATE for all of a challenge's solvers when its value changes,
+so nothing is summed when the leaderboard is read. After changing the
+engine, run `flask ctf rebuild-scoreboard` to recompute them.
+"""
+from flask import current_app
+from .ext import db
+from .models import Challenge, Solve, Team
+import math
+
+
+class StaticScoring(object):
+
+    def value(self, points, solves):
+        return points
+
+
+class DecayScoring(object):
+
+    def __init__(self, minimum=100, decay=30):
+        if decay < 1:
+            raise ValueError('decay must be at least 1')
+        self.minimum = minimum
+        self.decay = decay
+
+    def value(self, points, solves):
+        # Never worth more than its points, even if they are below minimum
+        minimum = min(self.minimum, points)
+        # The first solver gets the full points
+        n = min(max(solves - 1, 0), self.decay)
+        drop = (points - minimum) * n * n / self.decay ** 2
+        return max(minimum, int(math.ceil(points - drop)))
+
+
+ENGINES = {
+    'static': StaticScoring,
+    'decay': DecayScoring,
+}
+
+
+def get_engine():
+    options = dict(current_app.config['CTF'].get('scoring') or {})
+    kind = options.pop('type', 'static')
+    if kind not in ENGINES:
+        raise ValueError('Unknown scoring type %r' % kind)
+    return ENGINES[kind](**options)
+
+
+def set_value(challenge_id, value, old_value):
+    """Make the challenge worth value, moving every solver's score by the
+    difference in one UPDATE. Returns the ids of the teams rescored, if
+    the value changed."""
+    if value == old_value:
+        return []
+    solvers = (db.session.query(Solve.team_id)
+               .filter(Solve.challenge_id == challenge_id))
+    Team.query.filter(Team.id.in_(solvers)).update(
+        {Team.score: Team.score + (value - old_value)},
+        synchronize_session=False)
+    Challenge.query.filter(Challenge.id == challenge_id).update(
+        {Challenge.value: value}, synchronize_session=False)
+    return [team_id for team_id, in solvers]
+
+
+def record_solves(challenge_id, team_ids):
+    """Score new solves of a challenge by the given teams.
+
+    Their solve rows must already be flushed. Returns the ids of every
+    solver, if the value changed and so did their scores.
+    """
+    # Updating first locks the row, so concurrent solves count in turn
+    Challenge.query.filter(Challenge.id == challenge_id).update(
+        {Challenge.solve_count: Challenge.solve_count + len(team_ids)},
+        synchronize_session=False)
+    points, solves, value = (db.session.query(Challenge.points,
+                                              Challenge.solve_count,
+                                              Challenge.value)
+                             .filter(Challenge.id == challenge_id).one())
+    # The new solvers get the old value here, then the change with everyone
+    Team.query.filter(Team.id.in_(team_ids)).update(
+        {Team.score: Team.score + value}, synchronize_session=False)
+    return set_value(challenge_id, get_engine().value(points, solves), value)
+
+
+def rescore_challenge(challenge):
+    """Recompute a challenge's value after its points were edited."""
+    value = get_engine().value(challenge.points, challenge.solve_count)
+    return set_value(challenge.id, value, challenge.value)
+
+
+def recompute_values():
+    """Recount every challenge's solves and recompute its value."""
+    engine = get_engine()
+    counts = dict(db.session.query(Solve.challenge_id, db.func.count())
+                  .group_by(Solve.challenge_id))
+    for challenge in Challenge.query:
+        challenge.solve_count = counts.get(challenge.id, 0)
+        challenge.value = engine.value(challenge.points,
+                                       challenge.solve_count)
+    db.session.flush()
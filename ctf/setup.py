@@ -1,61 +1,327 @@
 from flask import current_app as app
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import inspect, text
+from sqlalchemy.orm import joinedload
+from . import scoring
 from .ext import db
 from os import path
 from .models import Challenge, Resource
-from .core import hash_fleg
+from .core import challenges_changed, hash_fleg, load_challenge_graph, \
+    load_fleg_index, rebuild_scoreboard, scoreboard_changed
+import hashlib
 import json
+import mmap
+import os
+import shutil
+
+
+CHALLENGE_FIELDS = ('title', 'description', 'category', 'points',
+                    'fleg_hash')
+
+# Files at least this big are hashed through mmap rather than read()
+MMAP_THRESHOLD = 16 * 1024 * 1024
 
 
 def build_problem_options(problem_config, category):
     problem = dict(problem_config)
     problem.pop('fleg')
-    problem.pop('resources')
-
     problem['fleg_hash'] = hash_fleg(problem_config['fleg'])
     problem['category'] = category
+    problem.setdefault('prerequisites', [])
+    problem.setdefault('resources', [])
+    return problem
 
-    # We put this first to avoid circular dependancies
-    prereqs = set()
-    if len(problem["prerequisites"]) > 0:
-        prereqs = Challenge.query.filter(
-            Challenge.title.in_(problem["prerequisites"])).all()
-        if len(problem["prerequisites"]) != len(prereqs):
-            raise ValueError("Prerequisite mismatch, %s" %
-                             problem["title"])
-    problem['prerequisites'] = set(prereqs)
 
-    return problem
+def get_challenge_path():
+    return path.join(app.root_path, "../", app.config['CTF']['challenges'])
 
 
-def build_challenges():
-    chal_path = path.join(app.root_path, "../",
-                          app.config['CTF']['challenges'])
-    categories = app.config['CTF']['categories']
-    for c in categories:
+def config_mtimes():
+    """Return the modification time of every category's problems.json."""
+    chal_path = get_challenge_path()
+    mtimes = {}
+    for c in app.config['CTF']['categories']:
+        problem_config = path.join(chal_path, c, "problems.json")
+        try:
+            mtimes[c] = os.stat(problem_config).st_mtime
+        except OSError:
+            mtimes[c] = None
+    return mtimes
+
+
+def get_store_path():
+    """Return the content-addressed resource store, or None if unset."""
+    store = app.config.get('RESOURCE_STORE')
+    if not store:
+        return None
+    return path.join(app.root_path, "../", store)
+
+
+def store_filename(sha256):
+    return path.join(get_store_path(), sha256[:2], sha256)
+
+
+def store_file(filename, sha256):
+    """Copy a file into the store, unless its contents are already there."""
+    target = store_filename(sha256)
+    if path.exists(target):
+        return
+    directory = path.dirname(target)
+    if not path.isdir(directory):
+        os.makedirs(directory)
+    # Copy then rename, so the store never holds a partial file
+    partial = '%s.%d.tmp' % (target, os.getpid())
+    shutil.copyfile(filename, partial)
+    os.rename(partial, target)
+
+
+def hash_file(filename):
+    """Return the hex SHA-256 of a file."""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+            contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                digest.update(contents)
+            finally:
+                contents.close()
+        else:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stat_resources(problems):
+    """Stat every problem's resource files, keyed by resource name."""
+    stats = {}
+    for problem in problems:
+        for name in problem['resources']:
+            filename = path.join(problem['path'], name)
+            try:
+                stats[name] = os.stat(filename)
+            except OSError:
+                raise ValueError("Missing resource %s for %s" %
+                                 (filename, problem['title']))
+    return stats
+
+
+def load_problems():
+    """Parse every category's problems.json, prerequisites first."""
+    chal_path = get_challenge_path()
+    problems = []
+    for c in app.config['CTF']['categories']:
         problem_config = path.join(chal_path, c, "problems.json")
         with open(problem_config, 'r') as config_file:
             try:
                 config = json.load(config_file)
             except ValueError:
                 raise ValueError("%s was malformed" % config_file)
-            for problem in config["problems"]:
-                problem_dict = build_problem_options(problem, c)
-                challenge = Challenge(**problem_dict)
-                db.session.add(challenge)
-
-                for f in problem["resources"]:
-                    file_path = path.join(chal_path, c)
-                    resource = Resource(name=f,
-                                        path=file_path,
-                                        challenge=challenge)
-                    db.session.add(resource)
-                try:
-                    db.session.commit()
-                except IntegrityError:
-                    db.session.rollback()
-                    challenge = Challenge.query.filter_by(
-                            title=problem['title'])
-                    problem_dict.update({'id': challenge.first().id})
-                    challenge.update(problem_dict)
-                    db.session.commit()
+        for problem in config["problems"]:
+            problem = build_problem_options(problem, c)
+            problem['path'] = path.join(chal_path, c)
+            problems.append(problem)
+    return sort_problems(problems)
+
+
+def sort_problems(problems):
+    """Topologically sort problems so prerequisites come before dependents.
+
+    Ties keep their order from the config files.
+    """
+    by_title = {}
+    for problem in problems:
+        if problem['title'] in by_title:
+            raise ValueError("Duplicate challenge title, %s" %
+                             problem['title'])
+        by_title[problem['title']] = problem
+
+    dependent = {}
+    for problem in problems:
+        for prereq in problem['prerequisites']:
+            if prereq not in by_title:
+                raise ValueError("Prerequisite mismatch, %s" %
+                                 problem['title'])
+            # Challenge.prerequisite_id can only point at one dependent
+            if prereq in dependent:
+                raise ValueError("%s is a prerequisite of more than one "
+                                 "challenge" % prereq)
+            dependent[prereq] = problem['title']
+
+    ordered = []
+    done = set()
+    remaining = list(problems)
+    while remaining:
+        ready = [p for p in remaining
+                 if set(p['prerequisites']) <= done]
+        if not ready:
+            raise ValueError("Circular prerequisites, %s" %
+                             ', '.join(p['title'] for p in remaining))
+        for problem in ready:
+            ordered.append(problem)
+            done.add(problem['title'])
+        remaining = [p for p in remaining if p['title'] not in done]
+    return ordered
+
+
+def build_challenges():
+    """Bring the challenge tables in line with the problems.json files.
+
+    Everything is parsed and validated before touching the database, the
+    existing rows are read in a single query, and all inserts and updates
+    are applied in one transaction. Resource files are only hashed (and
+    copied into RESOURCE_STORE, if set) when new or modified. Returns a
+    dict counting the challenges 'added', 'changed' and 'unchanged'.
+    """
+    problems = load_problems()
+    stats = stat_resources(problems)
+    store = get_store_path()
+
+    existing = {}
+    resources = {}
+    for challenge in (Challenge.query
+                      .options(joinedload(Challenge.resources))):
+        existing[challenge.title] = challenge
+        for resource in challenge.resources:
+            resources[resource.name] = resource
+
+    listed = set(name for p in problems for name in p['resources'])
+    added = set()
+    changed = set()
+    repointed = []
+    challenges = {}
+    for problem in problems:
+        title = problem['title']
+        challenge = existing.get(title)
+        if challenge is None:
+            challenge = Challenge(**dict((f, problem[f])
+                                         for f in CHALLENGE_FIELDS))
+            db.session.add(challenge)
+            added.add(title)
+        else:
+            for field in CHALLENGE_FIELDS:
+                if getattr(challenge, field) != problem[field]:
+                    setattr(challenge, field, problem[field])
+                    changed.add(title)
+                    if field == 'points':
+                        repointed.append(challenge)
+        challenges[title] = challenge
+
+        wanted = set(problem['resources'])
+        for resource in list(challenge.resources):
+            if resource.name not in wanted:
+                challenge.resources.remove(resource)
+                if resource.name not in listed:
+                    db.session.delete(resource)
+                    del resources[resource.name]
+                changed.add(title)
+        for name in problem['resources']:
+            resource = resources.get(name)
+            if resource is None:
+                resource = Resource(name=name)
+                resources[name] = resource
+                db.session.add(resource)
+            if resource.challenge is not challenge:
+                resource.challenge = challenge
+                changed.add(title)
+            stat = stats[name]
+            filename = path.join(problem['path'], name)
+            if (resource.path != problem['path'] or
+                    resource.sha256 is None or
+                    resource.size != stat.st_size or
+                    resource.mtime != stat.st_mtime):
+                sha256 = hash_file(filename)
+                if (resource.path, resource.sha256) != \
+                        (problem['path'], sha256):
+                    resource.path = problem['path']
+                    resource.sha256 = sha256
+                    changed.add(title)
+                resource.size = stat.st_size
+                resource.mtime = stat.st_mtime
+            if store is not None:
+                store_file(filename, resource.sha256)
+
+    # New challenges need ids before prerequisites can point at them
+    db.session.flush()
+
+    dependents = {}
+    for problem in problems:
+        for prereq in problem['prerequisites']:
+            dependents[prereq] = challenges[problem['title']].id
+    for title, challenge in challenges.items():
+        prerequisite_id = dependents.get(title)
+        if challenge.prerequisite_id != prerequisite_id:
+            challenge.prerequisite_id = prerequisite_id
+            changed.add(title)
+
+    rescored = set()
+    for challenge in repointed:
+        rescored.update(scoring.rescore_challenge(challenge))
+    db.session.commit()
+
+    changed -= added
+    if added or changed:
+        challenges_changed()
+    else:
+        load_fleg_index()
+        load_challenge_graph()
+    if rescored:
+        scoreboard_changed(rescored=rescored)
+
+    report = {
+        'added': len(added),
+        'changed': len(changed),
+        'unchanged': len(problems) - len(added) - len(changed),
+    }
+    app.logger.info('Challenges: %(added)d added, %(changed)d changed, '
+                    '%(unchanged)d unchanged', report)
+    return report
+
+
+def existing_indexes(table_name):
+    """Return the names of the indexes on a table, expression indexes
+    included (which SQLAlchemy's inspector skips)."""
+    engine = db.engine
+    if engine.dialect.name == 'sqlite':
+        query = ("SELECT name FROM sqlite_master "
+                 "WHERE type = 'index' AND tbl_name = :table")
+    elif engine.dialect.name == 'postgresql':
+        query = "SELECT indexname FROM pg_indexes WHERE tablename = :table"
+    else:
+        return set(i['name'] for i in
+                   inspect(engine).get_indexes(table_name))
+    return set(row[0] for row in
+               engine.execute(text(query), table=table_name))
+
+
+def migrate_db():
+    """Bring an existing database up to the current models.
+
+    Creates missing tables, adds missing columns and creates missing
+    indexes. Returns a list describing each change made.
+    """
+    engine = db.engine
+    db.create_all()
+    inspector = inspect(engine)
+    ddl = engine.dialect.ddl_compiler(engine.dialect, None)
+    changes = []
+
+    for table in db.metadata.sorted_tables:
+        columns = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in columns:
+                engine.execute('ALTER TABLE %s ADD COLUMN %s' % (
+                    ddl.preparer.format_table(table),
+                    ddl.get_column_specification(column)))
+                changes.append('Added column %s.%s' %
+                               (table.name, column.name))
+
+        indexes = existing_indexes(table.name)
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            if index.name not in indexes:
+                index.create(engine)
+                changes.append('Created index %s' % index.name)
+
+    if set(changes) & set(['Added column team.score',
+                           'Added column challenge.value']):
+        rebuild_scoreboard()
+        changes.append('Rebuilt the scoreboard')
+    return changes
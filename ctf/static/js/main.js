@@ -5,10 +5,47 @@ function setCookie(key, val) {
     + ';';
 };
 
+/* Move teams' rows to their new ranks, adding any that are new. Teams must
+   be in rank order. */
+function updateTeams(teams) {
+  var $table = $('table.table');
+  if (!$table.length) {
+    location.reload();
+    return;
+  }
+  var rows = teams.map(function(team) {
+    var $row = $('#team' + team.id);
+    if (!$row.length) {
+      var url = $table.data('team-url').replace(/0\/$/, team.id + '/');
+      $row = $('<tr><td></td><td><a></a></td><td></td></tr>')
+        .attr('id', 'team' + team.id);
+      $row.find('a').attr('href', url);
+    }
+    $row.find('a').text(team.name);
+    $row.children().eq(2).text(team.points);
+    return $row.detach();
+  });
+
+  /* With the moved rows out, the others are already in order */
+  $.each(teams, function(i, team) {
+    var $rows = $table.find('tr[id^="team"]');
+    if (team.rank <= $rows.length) {
+      $rows.eq(team.rank - 1).before(rows[i]);
+    } else {
+      $table.find('tbody').append(rows[i]);
+    }
+  });
+  $table.find('tr[id^="team"]').each(function(i) {
+    $(this).children().first().text(i + 1);
+  });
+}
+
 $(function() {
   /* Auto-update */
   (function() {
     var timer = null;
+    var source = null;
+    var streamUrl = $('#autoupdate').data('stream');
 
     var setUpdate = function() {
       return setTimeout(function () {
@@ -16,15 +53,39 @@ $(function() {
       }, 30000);
     }
 
+    var start = function() {
+      if (window.EventSource && streamUrl) {
+        source = new EventSource(streamUrl);
+        source.onmessage = function(e) {
+          var data = JSON.parse(e.data);
+          if (data.reload) {
+            location.reload();
+          } else {
+            updateTeams(data.teams || [data]);
+          }
+        };
+      } else {
+        timer = setUpdate();
+      }
+    };
+
+    var stop = function() {
+      if (source !== null) {
+        source.close();
+        source = null;
+      }
+      if (timer !== null) {
+        clearTimeout(timer);
+        timer = null;
+      }
+    };
+
     var updateReloadTimerState = function() {
       if ($(this).is(':checked')) {
         setCookie('autoupdate', '1');
-        timer = setUpdate();
+        start();
       } else {
-        if (timer !== null) {
-          clearTimeout(timer);
-          timer = null;
-        }
+        stop();
         setCookie('autoupdate', '0');
       }
     };
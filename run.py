@@ -1,4 +1,6 @@
 from ctf import create_app
 import os
 app = create_app()
-app.run(debug=True, port=int(os.environ.get('PORT', '5000')))
+
+if __name__ == '__main__':
+    app.run(debug=True, port=int(os.environ.get('PORT', '5000')))
@@ -0,0 +1,44 @@
+"""Serve the app from a single gevent process.
+
+Every request runs in its own greenlet and Redis/database sockets are patched
+to yield while they wait, so one process can hold thousands of concurrent
+API clients (leaderboard pollers, scoreboard streams) without a worker per
+connection. The routes and views are exactly the ones run.py serves.
+
+Argon2 would block every connection while it hashes, so it runs in gevent's
+threadpool instead, with as many threads as CTF.argon2.workers (default 10).
+"""
+try:
+    from gevent import monkey
+except ImportError:
+    raise SystemExit('serve.py needs gevent: pip install gevent')
+monkey.patch_all()
+
+from gevent import get_hub  # noqa: E402
+from gevent.pool import Pool  # noqa: E402
+from gevent.pywsgi import WSGIServer  # noqa: E402
+from ctf import create_app, passwords  # noqa: E402
+import os  # noqa: E402
+
+try:
+    # Make psycopg2 cooperative too, if we're running against Postgres
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+except ImportError:
+    pass
+
+app = create_app()
+# Open streams only cost a greenlet here, so the home page can use them
+app.config.setdefault('SCOREBOARD_STREAM', True)
+
+threadpool = get_hub().threadpool
+workers = app.config['CTF'].get('argon2', {}).get('workers')
+if workers:
+    threadpool.maxsize = workers
+passwords.executor = threadpool.apply
+
+if __name__ == '__main__':
+    port = int(os.environ.get('PORT', '5000'))
+    concurrency = int(os.environ.get('CONCURRENCY', '1000'))
+    server = WSGIServer(('', port), app, spawn=Pool(concurrency))
+    server.serve_forever()
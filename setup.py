@@ -4,4 +4,5 @@ setup(
     name='wrath-ctf-framework',
     version='0.2.0',
     packages=['ctf'],
+    python_requires='>=3.7',
 )
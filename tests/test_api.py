@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
-from ctf import create_app
+from ctf import cache, create_app, passwords
 import fakeredis
+import hashlib
 import json
 import pytest
 import os
+import time
 
 
 @pytest.fixture
@@ -240,6 +242,12 @@ def test_submit(app):
         api_req(client.post, '/api/flags/', no_team_user, fleg, 403,
                 'You must be part of a team.')
 
+        # Fail due to repeat, without scoring twice
+        api_req(client.post, '/api/flags/', user, fleg, 400,
+                'You\'ve already entered that flag.')
+        assert api_req(client.get, '/api/team', user, None, 200)['points'] \
+            == 30
+
         # Fail due to bad fleg
         fleg = {'flag': 'not_a_fleg'}
         api_req(client.post, '/api/flags/', user, fleg, 400, 'Nope.')
@@ -257,13 +265,18 @@ def test_challenges(app):
         api_req(client.post, '/api/teams/', user, post, 201)
 
         # Try to get challenges
-        assert api_req(client.get, '/api/challenges/', user, None, 200) == {
+        challenges = api_req(client.get, '/api/challenges/', user, None, 200)
+        url = challenges['challenges'][1].pop('resource_urls')['crypto.rb']
+        assert url.startswith('/files/signed/')
+        assert url.endswith('/crypto.rb')
+        assert challenges == {
             "challenges": [
                 {
                     "category": "example",
                     "description": "This is a test of the web problems",
                     "id": 2,
                     "points": 10,
+                    "resource_urls": {},
                     "resources": [],
                     "title": "Test Web"
                 },
@@ -284,6 +297,7 @@ def test_challenges(app):
             "description": "This is a test of the web problems",
             "id": 2,
             "points": 10,
+            "resource_urls": {},
             "resources": [],
             "solved": False,
             "title": "Test Web"
@@ -303,6 +317,7 @@ def test_challenges(app):
             "description": "This is a test of the web problems",
             "id": 2,
             "points": 10,
+            "resource_urls": {},
             "resources": [],
             "solved": True,
             "title": "Test Web"
@@ -314,6 +329,7 @@ def test_challenges(app):
             "description": "This is a test of the web problems",
             "id": 3,
             "points": 20,
+            "resource_urls": {},
             "resources": [],
             "solved": False,
             "title": "Test Web Dep"
@@ -343,3 +359,277 @@ def test_resources(app):
 
         # Fail due to nx file
         api_req(client.get, '/api/files/nx.rb', user, None, 404)
+
+
+def test_resource_caching(app):
+    with open('tests/challenges/example/crypto.rb', 'rb') as f:
+        contents = f.read()
+    etag = '"%s"' % hashlib.sha256(contents).hexdigest()
+
+    with app.test_client() as client:
+        user = auth(client, 'user')
+        api_req(client.post, '/api/teams/', user, {'name': 'PPP'}, 201)
+
+        def get(**headers):
+            headers['X-Session-Key'] = user
+            return client.get('/api/files/crypto.rb', headers=headers)
+
+        rv = get()
+        assert rv.headers['ETag'] == etag
+        assert rv.headers['Accept-Ranges'] == 'bytes'
+        assert 'private' in rv.headers['Cache-Control']
+        assert 'immutable' not in rv.headers['Cache-Control']
+
+        rv = get(**{'If-None-Match': etag})
+        assert rv.status_code == 304
+        assert rv.data == b''
+
+        rv = get(Range='bytes=2-5')
+        assert rv.status_code == 206
+        assert rv.data == contents[2:6]
+        assert rv.headers['Content-Range'] == \
+            'bytes 2-5/%d' % len(contents)
+
+        # Offloaded to the proxy, which gets an internal location instead
+        app.config['X_ACCEL_REDIRECT_PREFIX'] = '/_resources/'
+        rv = get()
+        assert rv.status_code == 200
+        assert rv.data == b''
+        assert rv.headers['X-Accel-Redirect'] == \
+            '/_resources/example/crypto.rb'
+        assert rv.headers['ETag'] == etag
+        assert get(**{'If-None-Match': etag}).status_code == 304
+
+        del app.config['X_ACCEL_REDIRECT_PREFIX']
+        app.config['USE_X_SENDFILE'] = True
+        rv = get()
+        assert rv.headers['X-Sendfile'] == \
+            os.path.abspath('tests/challenges/example/crypto.rb')
+
+
+def test_signed_downloads(app, monkeypatch):
+    with open('tests/challenges/example/crypto.rb', 'rb') as f:
+        contents = f.read()
+
+    with app.test_client() as client:
+        user = auth(client, 'user')
+        api_req(client.post, '/api/teams/', user, {'name': 'PPP'}, 201)
+        info = api_req(client.get, '/api/challenges/1/', user, None, 200)
+        url = info['resource_urls']['crypto.rb']
+
+        # No session needed
+        rv = client.get(url)
+        assert rv.status_code == 200
+        assert rv.data == contents
+        assert 'immutable' in rv.headers['Cache-Control']
+        assert rv.headers['Content-Disposition'] == \
+            'attachment; filename="crypto.rb"'
+
+        # Edited since the import, so the hash in the URL no longer holds
+        filename = 'tests/challenges/example/crypto.rb'
+        stat = os.stat(filename)
+        os.utime(filename, (stat.st_atime, stat.st_mtime + 10))
+        try:
+            rv = client.get(url)
+        finally:
+            os.utime(filename, (stat.st_atime, stat.st_mtime))
+        assert rv.status_code == 200
+        assert 'immutable' not in rv.headers['Cache-Control']
+        assert rv.headers['ETag'] != \
+            '"%s"' % hashlib.sha256(contents).hexdigest()
+
+        prefix, token, name = url.rsplit('/', 2)
+        assert client.get('%s/%s/other.rb' % (prefix, token)) \
+            .status_code == 404
+        assert client.get('%s/%sx/%s' % (prefix, token, name)) \
+            .status_code == 404
+
+        # Valid for at least RESOURCE_URL_TIMEOUT, but not forever
+        now = time.time()
+        monkeypatch.setattr(time, 'time', lambda: now + 600)
+        assert client.get(url).status_code == 200
+        monkeypatch.setattr(time, 'time', lambda: now + 1200)
+        assert client.get(url).status_code == 410
+
+
+def test_submit_rate_limit(app):
+    app.config['CTF']['rate_limits'] = {'team': {'limit': 2, 'window': 60}}
+    with app.test_client() as client:
+        user = auth(client, 'user')
+        api_req(client.post, '/api/teams/', user, {'name': 'PPP'}, 201)
+
+        fleg = {'flag': 'not_a_fleg'}
+        for _ in range(2):
+            api_req(client.post, '/api/flags/', user, fleg, 400, 'Nope.')
+
+        rv = client.post('/api/flags/', data=json.dumps(fleg), headers={
+            'Content-Type': 'application/json',
+            'X-Session-Key': user,
+        })
+        assert rv.status_code == 429
+        assert 0 < int(rv.headers['Retry-After']) <= 60
+        assert b'too quickly' in rv.data
+
+    # Per-IP limits are opt-in
+    app.config['CTF']['rate_limits'] = {'team': None,
+                                        'ip': {'limit': 1, 'window': 60}}
+    with app.test_client() as client:
+        user = auth(client, 'other')
+        api_req(client.post, '/api/teams/', user, {'name': 'Other'}, 201)
+        api_req(client.post, '/api/flags/', user, fleg, 400, 'Nope.')
+        rv = client.post('/api/flags/', data=json.dumps(fleg), headers={
+            'Content-Type': 'application/json',
+            'X-Session-Key': user,
+        })
+        assert rv.status_code == 429
+
+
+def test_password_pool(app):
+    app.config['CTF']['argon2'] = {'time_cost': 1, 'memory_cost': 256,
+                                   'workers': 2, 'max_queue': 2}
+    with app.test_client() as client:
+        auth(client, 'pooled')
+        api_req(client.post, '/api/sessions/', None, {
+            'username': 'pooled',
+            'password': 'test',
+        }, 201)
+        api_req(client.post, '/api/sessions/', None, {
+            'username': 'pooled',
+            'password': 'wrong',
+        }, 403, 'Incorrect username or password.')
+
+    assert passwords.stats['queued'] == 0
+    assert passwords.stats['completed'] >= 3
+    assert 1 <= passwords.stats['peak'] <= 2
+
+    app.config['INSTRUMENTATION'] = True
+    with app.test_client() as client:
+        body = client.get('/metrics').data.decode('utf-8')
+    assert '# TYPE ctf_argon2_pool_queued gauge\nctf_argon2_pool_queued 0' \
+        in body
+    assert 'ctf_argon2_pool_completed_total %d' \
+        % passwords.stats['completed'] in body
+
+    with app.app_context():
+        assert passwords.benchmark(0.1) > 0
+
+
+def test_password_executor(app, monkeypatch):
+    calls = []
+
+    def executor(func, args):
+        calls.append(func)
+        return func(*args)
+
+    monkeypatch.setattr(passwords, 'executor', executor)
+    app.config['CTF']['argon2'] = {'time_cost': 1, 'memory_cost': 256,
+                                   'workers': 2}
+    with app.test_client() as client:
+        auth(client, 'user')
+    assert calls == [passwords._hash]
+
+
+def test_leaderboard_stream(app):
+    with app.test_client() as client:
+        rv = client.get('/api/teams/stream', buffered=False)
+        assert rv.mimetype == 'text/event-stream'
+        events = iter(rv.response)
+        assert next(events) == b'retry: 5000\n\n'
+
+        user = auth(client, 'user')
+        api_req(client.post, '/api/teams/', user, {'name': 'PPP'}, 201)
+        api_req(client.post, '/api/flags/', user, {'flag': 'test_fleg'}, 201)
+
+        messages = []
+        while len(messages) < 2:
+            event = next(events)
+            if event.startswith(b'data: '):  # Skip keepalives
+                messages.append(event)
+        rv.close()
+
+    assert [json.loads(m[len(b'data: '):].decode('utf-8'))
+            for m in messages] == [
+        {'id': 1, 'name': 'PPP', 'points': 0, 'rank': 1},
+        {'id': 1, 'name': 'PPP', 'points': 30, 'rank': 1},
+    ]
+
+
+def test_instrumentation(app, caplog, monkeypatch):
+    with app.test_client() as client:
+        rv = client.get('/api/teams/')
+        assert 'Server-Timing' not in rv.headers
+        assert client.get('/metrics').status_code == 404
+
+        app.config['INSTRUMENTATION'] = True
+        app.config['SLOW_REQUEST_THRESHOLD'] = 0
+        rv = client.post('/api/users/', data=json.dumps({
+            'username': 'user',
+            'password': 'test',
+        }), content_type='application/json')
+        timing = rv.headers['Server-Timing']
+        assert timing.startswith('app;dur=')
+        for kind in ('sql', 'redis', 'argon2'):
+            assert '%s;desc=' % kind in timing
+        assert 'Slow request: POST /api/users/ (api.create_user)' \
+            in caplog.text
+
+        client.get('/api/teams/')
+        client.get('/api/teams/')
+        body = client.get('/metrics').data.decode('utf-8')
+        assert 'ctf_requests_total{endpoint="api.leaderboard",' \
+            'status="200"} 2' in body
+        assert 'ctf_request_duration_seconds_count' \
+            '{endpoint="api.create_user"} 1' in body
+        assert 'ctf_argon2_calls_total{endpoint="api.create_user"} 1' in body
+
+        # Requests that raise skip after_request, but are still counted
+        def broken(*args):
+            raise RuntimeError('broken')
+
+        monkeypatch.setattr(cache, 'get_leaderboard', broken)
+        with pytest.raises(RuntimeError):
+            client.get('/api/teams/')
+        body = client.get('/metrics').data.decode('utf-8')
+        assert 'ctf_requests_total{endpoint="api.leaderboard",' \
+            'status="500"} 1' in body
+        monkeypatch.undo()
+
+        app.config['METRICS_TOKEN'] = 'secret'
+        assert client.get('/metrics').status_code == 403
+        assert client.get('/metrics', headers={
+            'Authorization': 'Bearer secret',
+        }).status_code == 200
+
+
+def test_game_counters(app):
+    app.config['INSTRUMENTATION'] = True
+    with app.test_client() as client:
+        user = auth(client, 'user')
+        api_req(client.post, '/api/teams/', user, {'name': 'PPP'}, 201)
+        for fleg in ('not_a_fleg', 'test_fleg', 'test_fleg'):
+            client.post('/api/flags/', data=json.dumps({'flag': fleg}),
+                        headers={'Content-Type': 'application/json',
+                                 'X-Session-Key': user})
+        for password in ('test', 'wrong'):
+            client.post('/api/sessions/', data=json.dumps({
+                'username': 'user',
+                'password': password,
+            }), content_type='application/json')
+        client.get('/api/teams/')
+        client.get('/api/teams/')
+
+        body = client.get('/metrics').data.decode('utf-8')
+        for line in (
+                'ctf_flag_submissions_total{result="correct"} 1',
+                'ctf_flag_submissions_total{result="duplicate"} 1',
+                'ctf_flag_submissions_total{result="incorrect"} 1',
+                'ctf_solves_total{challenge="1"} 1',
+                'ctf_logins_total{result="failure"} 1',
+                'ctf_logins_total{result="success"} 1',
+                'ctf_sessions_created_total 2',
+                'ctf_leaderboard_cache_total{name="api",result="hit"} 1',
+                'ctf_leaderboard_cache_total{name="api",result="miss"} 1',
+                'ctf_argon2_verify_seconds_count 2',
+                'ctf_leaderboard_build_seconds_bucket'
+                '{name="api",le="+Inf"} 1'):
+            assert line + '\n' in body
@@ -6,6 +6,7 @@ import fakeredis
 import flask
 import pytest
 import os
+import sqlalchemy
 
 
 @pytest.fixture(scope='function')
@@ -67,6 +68,7 @@ def team_data(app):
                 )
                 ext.db.session.add(solve)
         ext.db.session.commit()
+        core.rebuild_scoreboard()
 
 
 @pytest.fixture
@@ -103,6 +105,37 @@ def test_create_user(app, client):
         assert user.name == 'harry'
 
 
+def test_identity_cache(app, user_without_team):
+    statements = []
+
+    def count(*args):
+        statements.append(args)
+
+    with app.app_context():
+        user = models.User.query.filter_by(name='harry').first()
+        key = core.create_session_key(user)
+        assert core.identity_for_token(key).team_id is None
+
+    with app.app_context():
+        sqlalchemy.event.listen(ext.db.engine, 'before_cursor_execute',
+                                count)
+        try:
+            identity = core.identity_for_token(key)
+        finally:
+            sqlalchemy.event.remove(ext.db.engine, 'before_cursor_execute',
+                                    count)
+        assert identity.name == 'harry'
+        assert statements == []
+
+    with app.app_context():
+        user = models.User.query.filter_by(name='harry').first()
+        team = core.create_team(user, 'Gryffindor')
+        assert core.identity_for_token(key).team_id == team.id
+
+        core.leave_team(user)
+        assert core.identity_for_token(key).team_id is None
+
+
 @pytest.mark.parametrize('username,password', [
     (None, None),
     (None, ''),
@@ -208,6 +241,68 @@ def test_home(client, team_data):
         ('team2', 0),
         ('team6', 0),
     ]
+    # Streaming holds a connection open, so it is only offered when asked
+    assert html.find(id='autoupdate').get('data-stream') is None
+
+
+def test_home_stream(app, client):
+    app.config['SCOREBOARD_STREAM'] = True
+    html = BeautifulSoup(client.get('/').data.decode('utf-8'),
+                         'html.parser')
+    assert html.find(id='autoupdate')['data-stream'] == '/api/teams/stream'
+
+
+def test_home_cached(app, client, team_data):
+    assert b'>team9<' in client.get('/').data
+
+    with app.app_context():
+        team = models.Team.query.filter_by(name='team9').first()
+        team.name = 'renamed'
+        ext.db.session.commit()
+    # Changed behind core's back, so the cached copy is still served
+    assert b'>team9<' in client.get('/').data
+
+    with app.app_context():
+        team = models.Team.query.filter_by(name='renamed').first()
+        core.rename_team(team, 'renamed again')
+    rv = client.get('/')
+    assert b'>team9<' not in rv.data
+    assert b'renamed again' in rv.data
+
+
+def test_rebuild_scoreboard(app, team_data):
+    with app.app_context():
+        team = models.Team.query.filter_by(name='team9').first()
+        team.score = 1000
+        team.last_solve = None
+        ext.db.session.commit()
+
+        core.rebuild_scoreboard()
+        team = models.Team.query.filter_by(name='team9').first()
+        assert team.score == 40
+        assert team.last_solve is not None
+        assert [t.name for t in core.get_teams()][:3] == \
+            ['team9', 'team5', 'team1']
+
+
+def test_replica_reads(app, user, tmpdir):
+    app.config['SQLALCHEMY_BINDS'] = {
+        'replica': 'sqlite:///' + str(tmpdir.join('replica.db')),
+    }
+    with app.app_context():
+        replica = ext.db.get_engine(bind='replica')
+        ext.db.Model.metadata.create_all(bind=replica)
+
+        # The replica is empty, so reads can't find the primary's team
+        team = models.Team.query.filter_by(name='Gryffindor').first()
+        assert core.get_teams() == []
+        assert core.get_team(team.id) is None
+
+        # Until the team writes, then it reads from the primary
+        core.add_fleg('test_fleg', team)
+        assert core.get_team(team.id).name == 'Gryffindor'
+        assert core.solved_ids(team) == set([1])
+        assert core.get_teams() == []
 
 
 def test_team_page(client, team_data):
@@ -230,6 +325,19 @@ def test_challenge_page(client, user):
     assert b'Test Web Dep' not in rv.data
 
 
+def test_challenge_graph(app, user):
+    with app.app_context():
+        ids = dict((c.title, c.id) for c in models.Challenge.query)
+        graph = core.get_challenge_graph()
+        assert graph[ids['Test Web Dep']] == 1 << ids['Test Web']
+        assert graph[ids['Test Web']] == 0
+
+        team = models.Team.query.filter_by(name='Gryffindor').first()
+        assert not core.check_prereqs(team, ids['Test Web Dep'])
+        core.add_fleg('test_fleg_returns', team)
+        assert core.check_prereqs(team, ids['Test Web Dep'])
+
+
 def test_challenge_page_unauthed(client):
     rv = client.get('/challenges/')
     assert rv.status_code == 303
@@ -261,6 +369,32 @@ def test_post_fleg_incorrect(client, user):
     assert b'Nope.' in rv.data
 
 
+def test_post_fleg_rate_limit(app, client, user):
+    app.config['CTF']['rate_limits'] = {'team': {'limit': 1, 'window': 60}}
+    client.post('/challenges/', data={'fleg': 'wrong_fleg'})
+    rv = client.post('/challenges/', data={'fleg': 'wrong_fleg'})
+    assert rv.status_code == 200
+    assert b'You are submitting flags too quickly.' in rv.data
+
+
+def test_incorrect_fleg_skips_database(app, user):
+    statements = []
+
+    def count(*args):
+        statements.append(args)
+
+    with app.test_request_context('/'):
+        team = models.Team.query.filter_by(name='Gryffindor').first()
+        engine = ext.db.engine
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', count)
+        try:
+            with pytest.raises(core.CtfException):
+                core.add_fleg('wrong_fleg', team)
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute', count)
+    assert statements == []
+
+
 def test_fleg_snoop(client, user):
     rv = client.post('/challenges/', data={'fleg': 'V375BrzPaT'})
     assert rv.status_code == 303
@@ -1,6 +1,16 @@
+from click.testing import CliRunner
+from ctf import audit, bench, cli, core, create_app, ext, ingest, models, \
+    scoring, setup
+from flask.cli import ScriptInfo
+import fakeredis
+import gzip
+import hashlib
+import json
 import pytest
+import redis
 import os
-from ctf import create_app
+import shutil
+import sqlalchemy
 
 
 def test_setup():
@@ -11,3 +21,449 @@ def test_setup():
     with pytest.raises(ValueError):
         os.environ["CTF_CONFIG"] = "tests/configs/teapot.json"
         create_app()
+
+
+@pytest.fixture
+def app():
+    os.environ["CTF_CONFIG"] = "tests/configs/good.json"
+    app = create_app()
+    app.redis = fakeredis.FakeRedis()
+    with app.app_context():
+        ext.db.create_all()
+    return app
+
+
+def test_build_challenges(app):
+    with app.app_context():
+        assert setup.build_challenges() == \
+            {'added': 3, 'changed': 0, 'unchanged': 0}
+        assert setup.build_challenges() == \
+            {'added': 0, 'changed': 0, 'unchanged': 3}
+
+        chal = models.Challenge.query.filter_by(title='Test Web').first()
+        chal.points = 1
+        ext.db.session.commit()
+        assert setup.build_challenges() == \
+            {'added': 0, 'changed': 1, 'unchanged': 2}
+        assert chal.points == 10
+
+        titles = [c.title for c in models.Challenge.query.order_by('id')]
+        assert titles == ['Test Crypto', 'Test Web', 'Test Web Dep']
+        assert models.Resource.query.count() == 1
+
+
+def test_resource_store(app, tmpdir, monkeypatch):
+    challenges = tmpdir.join('challenges')
+    shutil.copytree('tests/challenges', str(challenges))
+    app.config['CTF']['challenges'] = str(challenges)
+    app.config['RESOURCE_STORE'] = str(tmpdir.join('store'))
+    resource = challenges.join('example', 'crypto.rb')
+    sha256 = hashlib.sha256(resource.read_binary()).hexdigest()
+
+    hashed = []
+    hash_file = setup.hash_file
+    monkeypatch.setattr(setup, 'hash_file',
+                        lambda f: hashed.append(f) or hash_file(f))
+
+    with app.app_context():
+        setup.build_challenges()
+        row = models.Resource.query.one()
+        assert (row.sha256, row.size) == (sha256, resource.size())
+        stored = tmpdir.join('store', sha256[:2], sha256)
+        assert stored.read_binary() == resource.read_binary()
+        assert len(hashed) == 1
+
+        # Unchanged files aren't hashed again
+        setup.build_challenges()
+        assert len(hashed) == 1
+
+        resource.write('puts "changed"\n')
+        assert setup.build_challenges()['changed'] == 1
+        assert len(hashed) == 2
+        assert tmpdir.join('store').join(row.sha256[:2], row.sha256).check()
+
+        resource.remove()
+        with pytest.raises(ValueError):
+            setup.build_challenges()
+
+
+def test_challenges_version(app):
+    fleg_hash = core.hash_fleg('new_fleg')
+    with app.app_context():
+        setup.build_challenges()
+        chal = models.Challenge.query.filter_by(title='Test Web').first()
+        chal.fleg_hash = fleg_hash
+        ext.db.session.commit()
+
+    # Changed behind our back, so this process still has the old flegs
+    with app.app_context():
+        assert fleg_hash not in core.get_fleg_index()
+
+    # Another process changed the challenges
+    app.redis.incr(core.CHALLENGES_VERSION_KEY)
+    with app.app_context():
+        assert fleg_hash in core.get_fleg_index()
+
+
+def problem(title, prerequisites=()):
+    return {'title': title, 'prerequisites': list(prerequisites)}
+
+
+def test_sort_problems():
+    problems = [problem('c', ['b']), problem('a'), problem('b', ['a'])]
+    assert [p['title'] for p in setup.sort_problems(problems)] == \
+        ['a', 'b', 'c']
+
+    for problems in ([problem('a', ['b']), problem('b', ['a'])],
+                     [problem('a', ['nx'])],
+                     [problem('a'), problem('a')],
+                     [problem('a'), problem('b', ['a']),
+                      problem('c', ['a'])]):
+        with pytest.raises(ValueError):
+            setup.sort_problems(problems)
+
+
+def test_cli(app):
+    runner = CliRunner()
+    obj = ScriptInfo(create_app=lambda *args: app)
+
+    rv = runner.invoke(cli.cli, ['init-db'], obj=obj)
+    assert rv.exit_code == 0
+    rv = runner.invoke(cli.cli, ['sync-challenges'], obj=obj)
+    assert rv.output == '3 added, 0 changed, 0 unchanged.\n'
+    rv = runner.invoke(cli.cli, ['sync-challenges'], obj=obj)
+    assert rv.output == '0 added, 0 changed, 3 unchanged.\n'
+
+
+def test_no_setup_on_first_request(tmpdir):
+    with open('tests/configs/good.json') as f:
+        config = json.load(f)
+    config['SETUP_ON_FIRST_REQUEST'] = False
+    config_file = tmpdir.join('ctf.json')
+    config_file.write(json.dumps(config))
+
+    os.environ["CTF_CONFIG"] = str(config_file)
+    app = create_app()
+    assert not app.before_first_request_funcs
+
+
+def test_migrate_db(app):
+    with app.app_context():
+        engine = ext.db.engine
+        # The team table and solve index as they were before
+        # materialized scores
+        engine.execute('DROP INDEX ix_solve_team_earned')
+        engine.execute('DROP TABLE team')
+        engine.execute('CREATE TABLE team (id INTEGER PRIMARY KEY, '
+                       'name VARCHAR(128) UNIQUE)')
+        engine.execute("INSERT INTO team (name) VALUES ('PPP')")
+
+        assert setup.migrate_db() == [
+            'Added column team.score',
+            'Added column team.last_solve',
+            'Created index ix_team_name_lower',
+            'Created index ix_team_rank',
+            'Created index ix_solve_team_earned',
+            'Rebuilt the scoreboard',
+        ]
+        assert setup.migrate_db() == []
+        assert core.get_teams()[0].score == 0
+
+
+def file_db_app(tmpdir, database):
+    with open('tests/configs/good.json') as f:
+        config = json.load(f)
+    config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + \
+        str(tmpdir.join('ctf.db'))
+    config['CTF']['database'] = database
+    config_file = tmpdir.join('ctf.json')
+    config_file.write(json.dumps(config))
+
+    os.environ["CTF_CONFIG"] = str(config_file)
+    app = create_app()
+    app.redis = fakeredis.FakeRedis()
+    return app
+
+
+def test_sqlite_tuning(tmpdir):
+    app = file_db_app(tmpdir, {'busy_timeout': 1234})
+    with app.app_context():
+        engine = ext.db.engine
+        assert engine.execute('PRAGMA journal_mode').scalar() == 'wal'
+        assert engine.execute('PRAGMA busy_timeout').scalar() == 1234
+        # NORMAL
+        assert engine.execute('PRAGMA synchronous').scalar() == 1
+
+
+def test_bench_solves(tmpdir):
+    app = file_db_app(tmpdir, {'pool_size': 4})
+    with app.app_context():
+        ext.db.create_all()
+        results = bench.solve_throughput(teams=3, challenges=2, threads=2)
+        assert results['solves'] == 6
+        assert results['errors'] == 0
+        assert models.Team.query.count() == 0
+        assert models.Challenge.query.count() == 0
+
+        results = bench.solve_throughput(teams=3, challenges=2, threads=2,
+                                         queued=True)
+        assert results['solves'] == 6
+        assert results['errors'] == 0
+        assert results['saved'] >= results['seconds']
+        assert app.redis.llen(core.SOLVE_QUEUE_KEY) == 0
+        assert models.Solve.query.count() == 0
+
+
+def test_bench_load(tmpdir):
+    app = file_db_app(tmpdir, {})
+    with app.app_context():
+        ext.db.create_all()
+        setup.build_challenges()
+    runner = CliRunner()
+    obj = ScriptInfo(create_app=lambda *args: app)
+    baseline = str(tmpdir.join('baseline.json'))
+    args = ['bench-load', '--users', '4', '--teams', '2', '--challenges',
+            '2', '--concurrency', '2', '--seconds', '1', '--fake-redis']
+
+    rv = runner.invoke(cli.cli, args + ['--save', baseline], obj=obj)
+    assert rv.exit_code == 0, rv.output
+    lines = rv.output.splitlines()
+    assert lines[0].split()[:2] == ['operation', 'requests']
+    assert lines[-1].startswith('total')
+
+    with open(baseline) as f:
+        saved = json.load(f)
+    total = saved['results']['total']
+    assert total['requests'] > 0
+    assert total['errors'] == 0
+    assert total['p50'] <= total['p95'] <= total['p99']
+    assert saved['settings']['database'] == 'sqlite'
+
+    rv = runner.invoke(cli.cli, args + ['--compare', baseline], obj=obj)
+    assert rv.exit_code == 0, rv.output
+    assert '%)' in rv.output
+
+    with app.app_context():
+        assert models.User.query.count() == 0
+        assert models.Team.query.count() == 0
+
+
+def test_archive_submissions(app, tmpdir, monkeypatch):
+    runner = CliRunner()
+    obj = ScriptInfo(create_app=lambda *args: app)
+    with app.app_context():
+        setup.build_challenges()
+        team = models.Team(name='PPP')
+        ext.db.session.add(team)
+        ext.db.session.commit()
+        team_id = team.id
+        core.add_fleg('test_fleg_returns', team)
+        assert not app.redis.exists(audit.STREAM_KEY)
+
+        app.config['SUBMISSION_LOG_MAXLEN'] = 1000
+        for fleg in ('not_a_fleg', 'test_fleg', 'test_fleg'):
+            try:
+                core.add_fleg(fleg, team, '10.0.0.1', user_id=7)
+            except core.CtfException:
+                pass
+        assert app.redis.xlen(audit.STREAM_KEY) == 3
+
+    rv = runner.invoke(cli.cli, ['archive-submissions', '--batch', '2'],
+                       obj=obj)
+    assert rv.output == '3 submissions archived.\n'
+    rv = runner.invoke(cli.cli, ['archive-submissions'], obj=obj)
+    assert rv.output == '0 submissions archived.\n'
+
+    with app.app_context():
+        rows = models.Submission.query.order_by(models.Submission.id).all()
+        assert [(r.outcome, r.challenge_id) for r in rows] == \
+            [('incorrect', None), ('correct', 1), ('duplicate', 1)]
+        assert rows[1].hash_prefix == core.hash_fleg('test_fleg')[:16]
+        assert (rows[0].team_id, rows[0].user_id, rows[0].ip) == \
+            (team_id, 7, '10.0.0.1')
+
+        # Archiving again from scratch doesn't duplicate rows
+        app.redis.delete(audit.CHECKPOINT_KEY)
+        assert audit.archive() == 3
+        assert models.Submission.query.count() == 3
+
+        # Or archive to files instead
+        app.redis.delete(audit.CHECKPOINT_KEY)
+    rv = runner.invoke(cli.cli, ['archive-submissions', '--to-dir',
+                                 str(tmpdir)], obj=obj)
+    assert rv.output == '3 submissions archived.\n'
+    archive, = tmpdir.listdir('submissions-*.jsonl.gz')
+    with gzip.open(str(archive)) as f:
+        records = [json.loads(line.decode('utf-8')) for line in f]
+    assert [r['outcome'] for r in records] == \
+        ['incorrect', 'correct', 'duplicate']
+
+    # A Redis without streams loses the log entry, not the solve
+    real_execute_command = app.redis.execute_command
+
+    def execute_command(*args, **kwargs):
+        if args[0] == 'XADD':
+            raise redis.exceptions.ResponseError('unknown command XADD')
+        return real_execute_command(*args, **kwargs)
+
+    monkeypatch.setattr(app.redis, 'execute_command', execute_command)
+    with app.app_context():
+        team = models.Team.query.one()
+        assert core.add_fleg('test_fleg_dep', team).id == 3
+        assert models.Solve.query.count() == 3
+
+
+def test_solve_queue(app, monkeypatch):
+    app.config['SOLVE_QUEUE'] = True
+    runner = CliRunner()
+    obj = ScriptInfo(create_app=lambda *args: app)
+    with app.app_context():
+        setup.build_challenges()
+        ext.db.session.add(models.Team(name='PPP'))
+        ext.db.session.commit()
+        team = models.Team.query.one()
+
+        statements = []
+
+        def count(*args):
+            statements.append(args)
+
+        sqlalchemy.event.listen(ext.db.engine, 'before_cursor_execute',
+                                count)
+        try:
+            assert core.add_fleg('test_fleg', team).value == 30
+            with pytest.raises(core.CtfException):
+                core.add_fleg('test_fleg', team)
+        finally:
+            sqlalchemy.event.remove(ext.db.engine, 'before_cursor_execute',
+                                    count)
+        # Acknowledged without a query, and not saved yet
+        assert statements == []
+        assert models.Solve.query.count() == 0
+        queued = json.loads(app.redis.lindex(core.SOLVE_QUEUE_KEY, 0)
+                            .decode('utf-8'))
+        core.add_fleg('test_fleg_returns', team)
+
+    rv = runner.invoke(cli.cli, ['ingest-solves', '--once'], obj=obj)
+    assert rv.output == '2 solves ingested.\n'
+
+    with app.app_context():
+        team = models.Team.query.one()
+        assert team.score == 40
+        solve = models.Solve.query.filter_by(challenge_id=1).one()
+        assert solve.earned_on.strftime(core.SOLVE_TIME_FORMAT) == \
+            queued['earned_on']
+        assert core.get_teams()[0].score == 40
+
+        # Saved solves keep their claim, so they stay duplicates
+        claimed = core.SOLVE_CLAIMED_KEY % (team.id, 1)
+        assert app.redis.ttl(claimed) == -1
+        with pytest.raises(core.CtfException):
+            core.add_fleg('test_fleg', team)
+
+        # With the claim lost, the writer still doesn't count it twice
+        app.redis.delete(claimed)
+        core.add_fleg('test_fleg', team)
+        assert ingest.drain_solves() == 1
+        assert models.Solve.query.count() == 2
+        assert app.redis.ttl(claimed) == -1
+
+        # Solves the writer can't save give up their claim
+        ext.db.session.add(models.Team(name='LCBC'))
+        ext.db.session.commit()
+        gone = models.Team.query.filter_by(name='LCBC').one()
+        claimed = core.SOLVE_CLAIMED_KEY % (gone.id, 1)
+        core.add_fleg('test_fleg', gone)
+        ext.db.session.delete(gone)
+        ext.db.session.commit()
+        assert ingest.drain_solves() == 1
+        assert not app.redis.exists(claimed)
+
+        # A batch left behind by a crashed writer is finished, once, and
+        # never by two writers at the same time
+        app.redis.lpush(ingest.PROCESSING_KEY, json.dumps(queued))
+        app.redis.set(ingest.LOCK_KEY, 'other')
+        assert ingest.drain_solves() is None
+
+    rv = runner.invoke(cli.cli, ['ingest-solves', '--once'], obj=obj)
+    assert rv.output == '0 solves ingested.\n' \
+        'Stopped early: another writer holds the lock.\n'
+
+    with app.app_context():
+        app.redis.delete(ingest.LOCK_KEY)
+        assert ingest.drain_solves() == 1
+        assert not app.redis.exists(ingest.LOCK_KEY)
+        assert models.Solve.query.count() == 2
+        assert models.Team.query.one().score == 40
+        assert ingest.drain_solves() == 0
+
+        # A writer that outlived its lock leaves the next writer's alone
+        def overrun(batch_size):
+            app.redis.set(ingest.LOCK_KEY, 'next')
+            return 0
+        monkeypatch.setattr(ingest, 'write_batch', overrun)
+        ingest.drain_solves()
+        assert app.redis.get(ingest.LOCK_KEY) == b'next'
+
+
+def test_decay_scoring(app, monkeypatch):
+    app.config['CTF']['scoring'] = {'type': 'decay', 'minimum': 10,
+                                    'decay': 2}
+    with app.app_context():
+        engine = scoring.get_engine()
+        # Minimum is reached at solve decay + 1
+        assert [engine.value(30, n) for n in range(5)] == \
+            [30, 30, 25, 10, 10]
+        assert engine.value(5, 3) == 5
+
+        setup.build_challenges()
+        for name in ('A', 'B', 'C', 'D'):
+            ext.db.session.add(models.Team(name=name))
+        ext.db.session.commit()
+        teams = models.Team.query.order_by('id').all()
+
+        def scores():
+            return [t.score for t in models.Team.query.order_by('id')]
+
+        assert core.add_fleg('test_fleg', teams[0]).value == 30
+        assert core.add_fleg('test_fleg', teams[1]).value == 25
+        assert scores() == [25, 25, 0, 0]
+        pubsub = app.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(core.SCOREBOARD_CHANNEL)
+        pubsub.get_message()
+        monkeypatch.setattr(ext.db, 'has_replica', lambda: True)
+        assert core.add_fleg('test_fleg', teams[2]).value == 10
+        # The solver still reads its own writes
+        assert app.redis.exists(core.RECENT_WRITE_KEY % teams[2].id)
+        monkeypatch.undo()
+        # Every rescored solver is sent, in rank order
+        message = json.loads(pubsub.get_message()['data'].decode('utf-8'))
+        assert [(t['name'], t['points'], t['rank'])
+                for t in message['teams']] == \
+            [('A', 10, 1), ('B', 10, 2), ('C', 10, 3)]
+        core.add_fleg('test_fleg', teams[3])
+        assert scores() == [10, 10, 10, 10]
+        assert models.Challenge.query.get(1).solve_count == 4
+
+        core.add_fleg('test_fleg_returns', teams[0])
+        core.rebuild_scoreboard()
+        assert scores() == [20, 10, 10, 10]
+
+        # Editing points rescores the challenge's solvers
+        app.config['CTF']['scoring'] = None
+        models.Challenge.query.get(1).points = 1
+        ext.db.session.commit()
+        setup.build_challenges()
+        assert scores() == [40, 30, 30, 30]
+
+    # Queued solves of a challenge are rescored once per batch
+    app.config['CTF']['scoring'] = {'type': 'decay', 'minimum': 10,
+                                    'decay': 2}
+    app.config['SOLVE_QUEUE'] = True
+    with app.app_context():
+        core.rebuild_scoreboard()
+        teams = models.Team.query.order_by('id').all()
+        for team in teams[1:3]:
+            core.add_fleg('test_fleg_dep', team)
+        assert ingest.drain_solves() == 2
+        assert scores() == [20, 28, 28, 10]